@@ -5,7 +5,7 @@ from datetime import datetime
 import gevent
 from events import Events
 
-from gsensors.utils import full_exc_info
+from gsensors.utils import ErrorReporter
 
 
 class Alarm(object):
@@ -14,6 +14,7 @@ class Alarm(object):
     def __init__(self, name=None, title=None, msg=None, parent=None):
         self.name = name or self.__class__.__name__
         self._logger = logging.getLogger("gsensors.%s" % self.name)
+        self._reporter = ErrorReporter(self._logger)
         self.parent = parent
         self.title = title
         self.msg = msg
@@ -35,7 +36,7 @@ class Alarm(object):
                 callback(*args, **kwargs)
             except Exception as err:
                 self.error = "Callback error"
-                self._logger.error("Callback error: %s" % err, exc_info=full_exc_info())
+                self._reporter.report("Callback error", err)
         return wrapper
 
     def on_trigger(self, callback):
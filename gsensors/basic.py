@@ -1,21 +1,205 @@
 #-*- coding:utf-8 -*-
+import time
+import heapq
 import logging
 from datetime import datetime
 
 import gevent
-from events import Events
+from gevent.pool import Pool
+from gevent.event import Event
+
+from gsensors.utils import ErrorReporter
+from gsensors.history import ValueHistory
+
+class Scheduler(object):
+    """ Run periodic updates of many sources from a single greenlet
+
+    Deadlines are kept in a heap, each one computed from the previous
+    deadline (not from the end of the update) so they do not drift. First
+    updates run at once (spread over `start_spread` seconds), then the
+    phases are spread over the period to avoid all sources waking up at the
+    same time, and at most `max_concurrent` updates run at once.
+    """
+    max_concurrent = 50
+    start_spread = 1.   # max delay (seconds) of the first update
+
+    def __init__(self, max_concurrent=None):
+        self._logger = logging.getLogger("gsensors.Scheduler")
+        if max_concurrent is not None:
+            self.max_concurrent = max_concurrent
+        self._heap = []
+        self._seq = 0           # tie breaker for the heap
+        self._pool = Pool(self.max_concurrent)
+        self._running = set()   # sources with an update in progress
+        self._wakeup = Event()
+        self.worker = None
+        self.lateness = {}      # source -> (last, max) lateness in seconds
+        self._nb_added = 0
+        self._anchors = {}      # source -> deadline of its second update
+
+    def add(self, source, period, phase=None):
+        """ Call `source._checked_update` every `period` seconds
+
+        :param phase: delay before first update. By default the first
+            update runs at once, and the n-th added source is then updated
+            at (n * golden ratio) modulo 1 of the period, which spreads the
+            updates evenly, whatever the number of sources.
+        """
+        now = time.time()
+        if phase is not None:
+            self._push(now + phase, source, period)
+            self.start()
+            return
+        spread = (self._nb_added * 0.618033988749895) % 1
+        self._nb_added += 1
+        first = now + spread * min(self.start_spread, period)
+        anchor = now + spread * period
+        if anchor <= first:
+            anchor += period
+        self._anchors[source] = anchor
+        self._push(first, source, period)
+        self.start()
+
+    def _push(self, deadline, source, period):
+        self._seq += 1
+        heapq.heappush(self._heap, (deadline, self._seq, source, period))
+        if self._heap[0][2] is source:
+            self._wakeup.set()
+
+    def start(self):
+        if self.worker is None:
+            self.worker = gevent.spawn(self._loop)
+
+    def _loop(self):
+        while True:
+            if not self._heap:
+                timeout = None
+            else:
+                timeout = max(0, self._heap[0][0] - time.time())
+            if self._wakeup.wait(timeout):
+                self._wakeup.clear()
+                continue
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, source, period = heapq.heappop(self._heap)
+                self._run(source, deadline, now)
+                # next deadline, skip missed periods
+                next_deadline = self._anchors.pop(source, deadline + period)
+                if next_deadline <= now:
+                    next_deadline += ((now - next_deadline) // period + 1) * period
+                self._push(next_deadline, source, period)
+
+    def _run(self, source, deadline, now):
+        if source in self._running:
+            self._logger.warning("%s: previous update still running, skip" % source.name)
+            return
+        late = now - deadline
+        _, max_late = self.lateness.get(source, (0, 0))
+        self.lateness[source] = (late, max(late, max_late))
+        self._running.add(source)
+        self._pool.spawn(self._update, source)
+
+    def _update(self, source):
+        try:
+            source._checked_update()
+        finally:
+            self._running.discard(source)
+
+
+_default_scheduler = None
+
+def default_scheduler():
+    """ Scheduler used by the sources that are not managed by a GSensorApp
+    """
+    global _default_scheduler
+    if _default_scheduler is None:
+        _default_scheduler = Scheduler()
+    return _default_scheduler
+
+
+class DeadlineTracker(object):
+    """ Detect the sources that get no data for more than their timeout
+
+    Deadlines of all the sources are kept in a single heap, checked by a
+    single greenlet. Re-arming a source only updates its deadline, the heap
+    entry is moved when it comes up, so there is at most one entry per
+    source.
+    """
+    def __init__(self):
+        self._heap = []
+        self._seq = 0           # tie breaker for the heap
+        self._deadlines = {}    # source -> current deadline
+        self._queued = set()    # sources with an entry in the heap
+        self._wakeup = Event()
+        self.worker = None
+
+    def arm(self, source, timeout):
+        """ (Re)start the timeout of a source
+        """
+        deadline = time.time() + timeout
+        self._deadlines[source] = deadline
+        if source not in self._queued:
+            self._push(deadline, source)
+
+    def disarm(self, source):
+        self._deadlines.pop(source, None)
+
+    def _push(self, deadline, source):
+        self._seq += 1
+        heapq.heappush(self._heap, (deadline, self._seq, source))
+        self._queued.add(source)
+        if self._heap[0][2] is source:
+            self._wakeup.set()
+        if self.worker is None:
+            self.worker = gevent.spawn(self._loop)
+
+    def _loop(self):
+        while True:
+            if not self._heap:
+                timeout = None
+            else:
+                timeout = max(0, self._heap[0][0] - time.time())
+            if self._wakeup.wait(timeout):
+                self._wakeup.clear()
+                continue
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, _, source = heapq.heappop(self._heap)
+                self._queued.discard(source)
+                deadline = self._deadlines.get(source)
+                if deadline is None:
+                    continue    # disarmed
+                if deadline > now:
+                    self._push(deadline, source)    # re-armed meanwhile
+                    continue
+                del self._deadlines[source]
+                source._timed_out()
+
+
+_default_deadline_tracker = None
+
+def default_deadline_tracker():
+    """ Deadline tracker used by the sources that are not managed by a GSensorApp
+    """
+    global _default_deadline_tracker
+    if _default_deadline_tracker is None:
+        _default_deadline_tracker = DeadlineTracker()
+    return _default_deadline_tracker
 
-from gsensors.utils import full_exc_info
 
 class GSensorApp():
     debug = False
 
-    def __init__(self):
+    def __init__(self, max_concurrent=None):
         self.sources = []
+        self.scheduler = Scheduler(max_concurrent=max_concurrent)
+        self.deadline_tracker = DeadlineTracker()
 
     def add(self, source):
         self.sources.append(source)
         source.debug = self.debug
+        source.scheduler = self.scheduler
+        source.deadline_tracker = self.deadline_tracker
 
     def run(self):
         for source in self.sources:
@@ -24,26 +208,157 @@ class GSensorApp():
         gevent.wait()
 
 
+class _Listeners(object):
+    """ Callbacks of one event, stored in flat lists
+
+    * `callbacks[i]` is called with the event arguments if `filters[i]` is
+      None, else with the value only if `filters[i](value)` is true,
+    * `by_value` maps a value to the callbacks registered for this exact
+      value (called with the value only).
+    """
+    __slots__ = ("callbacks", "filters", "by_value")
+
+    def __init__(self):
+        self.callbacks = []
+        self.filters = []
+        self.by_value = None
+
+    def add(self, callback, value=None):
+        if value is not None and not callable(value):
+            try:
+                if self.by_value is None:
+                    self.by_value = {}
+                self.by_value.setdefault(value, []).append(callback)
+                return
+            except TypeError:
+                # unhashable value
+                value = _equals(value)
+        self.callbacks.append(callback)
+        self.filters.append(value)
+
+
+def _equals(ref):
+    def value_filter(value):
+        return value == ref
+    return value_filter
+
+
 class DataSource(object):
     """ Abstract data source model
+
+    Attributes are stored in slots, and listeners lists are only allocated
+    when a callback is registered, so a source is cheap to create.
     """
-    debug = False
-    timeout = -1 # no timeout by default
-   #TODO
-   
+    __slots__ = ("name", "unit", "_timeout", "debug", "last_update",
+        "scheduler", "deadline_tracker", "_value", "_error", "_log",
+        "_reporter", "_listeners", "history", "__weakref__")
+
+    default_timeout = -1 # no timeout by default
+    TIMEOUT_ERROR = "Timeout"   # error set when timeout is reached
+
     def __init__(self, name=None, unit=None, timeout=None):
         self.name = name or self.__class__.__name__
-        self._logger = logging.getLogger("gsensors.%s" % self.name)
+        self._log = None        # logger, get on first use
+        self._reporter = None   # :class:`ErrorReporter`, created on first error
+        self._listeners = None  # event name -> list of callbacks
 
-        self.events = Events()
+        self.debug = False
+        self.scheduler = None   # :class:`Scheduler` used for periodic updates
+        self.deadline_tracker = None # :class:`DeadlineTracker` used for timeouts
 
         self.unit = unit
         self._value = 0
         self._error = None
 
+        self._timeout = None    # None: class default
         if timeout is not None:
             self.timeout = timeout
         self.last_update = None     # datetime on last update
+        self.history = None     # :class:`ValueHistory` (see `enable_history`)
+
+    @property
+    def timeout(self):
+        """ Max seconds without data (no timeout if <= 0), subclasses may
+        also set it as a class attribute
+        """
+        if self._timeout is None:
+            return self.default_timeout
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+
+    @property
+    def _logger(self):
+        if self._log is None:
+            self._log = logging.getLogger("gsensors.%s" % self.name)
+        return self._log
+
+    @_logger.setter
+    def _logger(self, logger):
+        self._log = logger
+
+    def _add_listener(self, event, callback, value=None):
+        if self._listeners is None:
+            self._listeners = {}
+        if event not in self._listeners:
+            self._listeners[event] = _Listeners()
+        self._listeners[event].add(callback, value)
+
+    def _fire(self, event, *args):
+        """ Call the listeners of an event, value filters are checked on the
+        last argument
+        """
+        if self._listeners is None:
+            return
+        listeners = self._listeners.get(event)
+        if listeners is None:
+            return
+        value = args[-1]
+        callbacks = listeners.callbacks
+        filters = listeners.filters
+        nb_callbacks = len(callbacks)
+        num = 0
+        while num < nb_callbacks:
+            # single try for the loop, resumed after a failing callback
+            try:
+                while num < nb_callbacks:
+                    callback = callbacks[num]
+                    value_filter = filters[num]
+                    num += 1
+                    if value_filter is None:
+                        callback(*args)
+                    elif value_filter(value):
+                        callback(value)
+            except Exception as err:
+                self._callback_error(err)
+        if listeners.by_value:
+            try:
+                callbacks = listeners.by_value.get(value, ())
+            except TypeError:
+                # unhashable value
+                return
+            nb_callbacks = len(callbacks)
+            num = 0
+            while num < nb_callbacks:
+                try:
+                    while num < nb_callbacks:
+                        callback = callbacks[num]
+                        num += 1
+                        callback(value)
+                except Exception as err:
+                    self._callback_error(err)
+
+    @property
+    def error_reporter(self):
+        if self._reporter is None:
+            self._reporter = ErrorReporter(self._logger)
+        return self._reporter
+
+    def _callback_error(self, err):
+        self.error = "Callback error"
+        self.error_reporter.report("Callback error", err)
 
     @property
     def value(self):
@@ -57,11 +372,33 @@ class DataSource(object):
         self.set_value(val, update_time=now)
 
     def set_value(self, val, update_time=None):
-        self.events.on_update(self, val)
+        self._keep_alive()
+        if self.history is not None:
+            self._record(val)
+        # set before the callbacks, so they get the time of this update
+        self.last_update = update_time
+        if self._listeners is None:
+            # fast path: nobody to call
+            self._value = val
+            return
+        self._fire("on_update", self, val)
         if val != self._value:
             self._value = val
-            self.last_update = update_time
-            self.events.on_change(self, val)
+            self._fire("on_change", self, val)
+
+    def enable_history(self, size, window=None):
+        """ Keep the last `size` values (received in the last `window`
+        seconds if given), aggregates are then added to `export()`
+        """
+        self.history = ValueHistory(size, window=window)
+        return self.history
+
+    def _record(self, val):
+        try:
+            val = float(val)
+        except (TypeError, ValueError):
+            return  # not a numeric value
+        self.history.append(val)
 
     @property
     def error(self):
@@ -74,69 +411,62 @@ class DataSource(object):
             old_err = self._error
             self._error = err
             if self._error is not None:
-                self.events.on_error(self, err)
+                self._fire("on_error", self, err)
             else:
-                self.events.on_error_release(self, old_err)
-
-    def _checked_callback(self, callback):
-        def wrapper(*args, **kwargs):
-            try:
-                callback(*args, **kwargs)
-            except Exception as err:
-                self.error = "Callback error"
-                self._logger.error("Callback error: %s" % err, exc_info=full_exc_info())
-        return wrapper
-
-    def _callback_wrap_onvalue(self, callback, value):
-        if callable(value):
-            def wrapper(source, new_value):
-                if value(new_value):
-                    callback(new_value)
-        else:
-            def wrapper(source, new_value):
-                #self._logger.debug("%s =? %s" % (new_value, value))
-                if new_value == value:
-                    callback(new_value)
-        return wrapper
+                self._fire("on_error_release", self, old_err)
 
     def on_update(self, callback, value=None):
         """ Callback when value is updated (even if it stays the same). 
         
         If `value` is given the callback will be called only if the new value
-        equals it.
+        equals it (or if `value(new_value)` is true when it is callable).
         """
-        if value is not None:
-            callback = self._callback_wrap_onvalue(callback, value)
-        callback = self._checked_callback(callback)
-        self.events.on_update += callback
+        self._add_listener("on_update", callback, value)
 
     def on_change(self, callback, value=None):
         """ Callback when value changed. If `value` is given the callback
-        will be called only if the new value equals it.
+        will be called only if the new value equals it (or if
+        `value(new_value)` is true when it is callable).
         """
-        if value is not None:
-            callback = self._callback_wrap_onvalue(callback, value)
-        callback = self._checked_callback(callback)
-        self.events.on_change += callback
+        self._add_listener("on_change", callback, value)
 
     def on_timeout(self, callback):
-        #TODO
-        raise NotImplementedError
+        """ Callback when no data was received for `timeout` seconds
+        (the error is then set to `TIMEOUT_ERROR`)
+        """
+        self._add_listener("on_timeout", callback)
+
+    def _arm_timeout(self):
+        tracker = self.deadline_tracker or default_deadline_tracker()
+        tracker.arm(self, self.timeout)
+
+    def _keep_alive(self):
+        """ Data was received: restart the timeout (and release its error)
+        """
+        if self.timeout > 0:
+            self._arm_timeout()
+            if self._error == self.TIMEOUT_ERROR:
+                self.error = None
+
+    def _timed_out(self):
+        self._logger.warning("No data since %ss" % self.timeout)
+        self.error = self.TIMEOUT_ERROR
+        self._fire("on_timeout", self)
 
     def on_error(self, callback):
         """ Callback when an error occurs (property error changed and is not None)
         """
-        callback = self._checked_callback(callback)
-        self.events.on_error += callback
+        self._add_listener("on_error", callback)
 
     def on_error_release(self, callback):
         """ Callback when there is no more error (property error changed back to None)
         """
-        callback = self._checked_callback(callback)
-        self.events.on_error_release += callback
+        self._add_listener("on_error_release", callback)
 
     def start(self):
-        pass
+        # arm the timeout now, so a source that never gets data times out
+        if self.timeout > 0:
+            self._arm_timeout()
 
     def export(self):
         """ Data given to the clients on each change
@@ -150,6 +480,8 @@ class DataSource(object):
         res["error"] = self.error
         if self.last_update is not None:
             res["last_update"] = self.last_update.isoformat()
+        if self.history is not None:
+            res["history"] = self.history.aggregates()
         return res
 
     def desc(self):
@@ -166,11 +498,11 @@ class AutoUpdateValue(DataSource):
     """
     unit = ""
     update_freq = 1     # frequence of update
+    started = False
 
     def __init__(self, name=None, unit=None, update_freq=None):
         super(AutoUpdateValue, self).__init__(name=name, unit=unit)
         # update timeput
-        self.worker = None
         self.last_update = None
         if update_freq is not None:
             self.update_freq = update_freq or AutoUpdateValue.update_freq
@@ -191,17 +523,20 @@ class AutoUpdateValue(DataSource):
             self.update()
         except Exception as err:
             self.error = "Error"
-            self._logger.error("Update error: %s" % err, exc_info=full_exc_info())
-
-    def update_work(self):
-        while True:
-            self._logger.debug("Update !")
-            self._checked_update()
-            gevent.sleep(self.update_freq)
+            self.error_reporter.report("Update error", err)
+        else:
+            # an update may also report its errors and set `error` itself
+            if self._reporter is not None and self._error is None:
+                self._reporter.clear()
+            # sources publishing through child sources never call set_value
+            self._keep_alive()
 
     def start(self):
-        if self.worker is None:
-            self.worker = gevent.spawn(self.update_work)
+        if not self.started:
+            self.started = True
+            scheduler = self.scheduler or default_scheduler()
+            scheduler.add(self, self.update_freq)
+            super(AutoUpdateValue, self).start()
 
 
 class StupidCount(AutoUpdateValue):
@@ -225,3 +560,47 @@ def PrintError():
     def _print(source, error):
         print("%s ERROR: %s" % (source.name, error))
     return _print
+
+
+def benchmark(sizes=(10000, 100000), nb_updates=10, make_source=None):
+    """ Memory used by DataSource instances and `set_value` throughput
+
+    :param make_source: function num -> source, to benchmark a subclass
+        (plain DataSource by default)
+    """
+    import gc
+    import resource
+    if make_source is None:
+        make_source = lambda num: DataSource(name="src%d" % num)
+    for size in sizes:
+        gc.collect()
+        mem_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        begin_at = time.time()
+        sources = [make_source(num) for num in range(size)]
+        create_time = time.time() - begin_at
+        mem_used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - mem_before
+        print("%7d %s: created in %.3fs, max RSS +%d kB" % (size, sources[0].__class__.__name__, create_time, mem_used))
+        begin_at = time.time()
+        for num in range(nb_updates):
+            for source in sources:
+                source.set_value(num)
+        duration = time.time() - begin_at
+        print("%7d sources: %.0f set_value/s without listener" % (size, size*nb_updates/duration))
+        for source in sources:
+            source.on_change(lambda source, value: None)
+        begin_at = time.time()
+        for num in range(nb_updates):
+            for source in sources:
+                source.set_value(num + nb_updates)
+        duration = time.time() - begin_at
+        print("%7d sources: %.0f set_value/s with one listener" % (size, size*nb_updates/duration))
+        del sources
+
+
+def main():
+    benchmark()
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#-*- coding:utf-8 -*-
+""" Sources computed from other sources
+"""
+import heapq
+from datetime import datetime
+
+import gevent
+
+from gsensors.basic import DataSource
+
+
+class DependencyGraph(object):
+    """ Recompute the computed sources whose inputs changed
+
+    Changes are coalesced until a flush greenlet runs (at the next hub
+    iteration), then the dirty sources are recomputed by increasing rank
+    (depth in the graph), so each one is computed once, after all its
+    inputs. The flush runs in a greenlet, not in the hub, so downstream
+    callbacks may block (sleep, network...).
+    """
+    def __init__(self):
+        self._dirty = []        # heap of (rank, seq, source)
+        self._queued = set()
+        self._seq = 0           # tie breaker for the heap
+        self._scheduled = False
+
+    def mark(self, source):
+        """ Source needs to be recomputed
+        """
+        if source in self._queued:
+            return
+        self._seq += 1
+        heapq.heappush(self._dirty, (source.rank, self._seq, source))
+        self._queued.add(source)
+        if not self._scheduled:
+            self._scheduled = True
+            gevent.spawn(self.flush)
+
+    def flush(self):
+        try:
+            while self._dirty:
+                _, _, source = heapq.heappop(self._dirty)
+                self._queued.discard(source)
+                # may mark sources of higher rank, computed in this loop
+                source.recompute()
+        finally:
+            self._scheduled = False
+
+
+_default_graph = None
+
+def default_graph():
+    global _default_graph
+    if _default_graph is None:
+        _default_graph = DependencyGraph()
+    return _default_graph
+
+
+class ComputedSource(DataSource):
+    """ Source whose value is a function of other sources values
+
+    >>> dew_point = ComputedSource(compute_dew_point, [htu.temp, htu.hum], unit="°C") # doctest: +SKIP
+
+    The function is called with the inputs values (in the given order), only
+    when at least one of them changed, and never while an input has an
+    error. Downstream sources are not recomputed if the value is the same.
+    """
+    def __init__(self, func, inputs, name=None, unit=None, timeout=None, graph=None):
+        super(ComputedSource, self).__init__(name=name, unit=unit, timeout=timeout)
+        self.func = func
+        self.inputs = list(inputs)
+        self.graph = graph or default_graph()
+        # rank: 1 + max rank of inputs (plain sources have rank 0)
+        self.rank = 1 + max([getattr(source, "rank", 0) for source in self.inputs] or [0])
+        for source in self.inputs:
+            source.on_change(self._input_changed)
+            source.on_error(self._input_changed)
+            source.on_error_release(self._input_changed)
+        self.error = "No data"
+        self.graph.mark(self)   # compute once, even if inputs never change
+
+    def _input_changed(self, source, value):
+        self.graph.mark(self)
+
+    def recompute(self):
+        for source in self.inputs:
+            if source.error is not None:
+                self.error = "Input error (%s)" % source.name
+                return
+        try:
+            value = self.func(*[source.value for source in self.inputs])
+        except Exception as err:
+            self.error = "Compute error"
+            self.error_reporter.report("Compute error", err)
+            return
+        self.error = None
+        if value != self.value:
+            self.set_value(value, update_time=datetime.now())
+
+    def start(self):
+        super(ComputedSource, self).start()
+        for source in self.inputs:
+            source.start()
+        self.graph.mark(self)
@@ -3,30 +3,175 @@
 """
 import logging
 from datetime import datetime
+from collections import defaultdict
 
 import gevent
+from gevent.socket import wait_read
 import logging
 import serial
-import xmltodict
+from xml.parsers import expat
 from xml.parsers.expat import ExpatError
 
 from gsensors.basic import DataSource
+from gsensors.utils import ErrorReporter
+
+
+# markers used by the parser for history data
+_HIST_DATA = object()
+_HIST_LEAF = object()
+
+
+class CurrentcostParser(object):
+    """ Streaming parser of CurrentCost XML messages that only extracts some
+    fields, without building the whole document.
+
+    Fields are given as path relative to the `<msg>` root, for instance
+    "ch1/watts" or "tmpr". `parse` returns a dict field -> text.
+
+    If `history` is True, the `<data>` blocks of history messages are
+    returned in the "hist" entry as a list of dict tag -> text.
+    """
+    def __init__(self, fields=(), history=False):
+        self._wanted = {}   # tree of wanted tags: {"ch1": {"watts": {}}, ...}
+        self.history = history
+        for field in fields:
+            self.add_field(field)
+
+    def add_field(self, field):
+        node = self._wanted
+        for tag in field.split("/"):
+            node = node.setdefault(tag, {})
+
+    def parse(self, data):
+        record = {}
+        nodes = [None]      # stack of wanted tree nodes (None if not wanted)
+        path = []
+        text = []
+        hist_data = []
+        wanted = self._wanted
+        history = self.history
+
+        def start_element(name, attrs):
+            parent = nodes[-1]
+            if parent is None or parent is _HIST_LEAF:
+                # root <msg> element
+                node = wanted if len(nodes) == 1 else None
+            elif parent is _HIST_DATA:
+                node = _HIST_LEAF
+            else:
+                node = parent.get(name)
+            if history and name == "data" and len(path) == 2 and path[1] == "hist":
+                hist_data.append({})
+                node = _HIST_DATA
+            nodes.append(node)
+            path.append(name)
+            del text[:]
+
+        def end_element(name):
+            node = nodes.pop()
+            if node is _HIST_LEAF:
+                hist_data[-1][name] = "".join(text).strip()
+            elif node is not None and not node and len(path) > 1:
+                # wanted leaf
+                record["/".join(path[1:])] = "".join(text).strip()
+            path.pop()
+
+        def char_data(data):
+            if nodes[-1] is not None:
+                text.append(data)
+
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CharacterDataHandler = char_data
+        parser.Parse(data, True)
+        if hist_data:
+            record["hist"] = hist_data
+        return record
 
 
 class CurrentcostSerial(object):
+    """ CurrentCost (ENVI/CC128) connected on a serial port
+
+    Sources are indexed by (sensor id, field) so each message is only given
+    to the sources of the sensor it comes from.
+    """
     def __init__(self, serial_dev, **kwargs):
         self._logger = logging.getLogger("gsensors.CCSerial")
+        self._reporter = ErrorReporter(self._logger)
         self._serial_dev = serial_dev
         self._ser = None
-        self._sources = []
+        self._routes = defaultdict(list)   # (sensor id or None, field) -> sources
+        self._history_callbacks = []
+        self._parser = CurrentcostParser(["sensor"])
         self.running = False
 
-    def get_data(self, data):
-        for source in self._sources:
-            source.update(data)
+    def get_data(self, record):
+        try:
+            sensor = int(record.get("sensor") or 0)
+        except ValueError:
+            self._logger.error("Invalid sensor id: %r" % record.get("sensor"))
+            return
+        routes = self._routes
+        for field, data in record.items():
+            for key in ((sensor, field), (None, field)):
+                sources = routes.get(key)
+                if sources:
+                    for source in sources:
+                        source.update(data)
+        if "hist" in record:
+            self.get_history(record["hist"])
+
+    def get_history(self, hist_data):
+        """ Give history data to the callbacks, as (sensor id, data) where
+        data is a dict period -> value (ex: {"h024": 1.1, "d001": 12.3})
+        """
+        for data in hist_data:
+            try:
+                sensor = int(data.pop("sensor", 0))
+            except ValueError:
+                self._logger.error("Invalid history sensor id")
+                continue
+            values = {}
+            for period, value in data.items():
+                try:
+                    values[period] = float(value)
+                except ValueError:
+                    continue
+            for callback in self._history_callbacks:
+                try:
+                    callback(sensor, values)
+                except Exception as err:
+                    self._reporter.report("History callback error", err)
+
+    def register_source(self, source, field, sensor=None):
+        """ Register a source for a field (ex: "ch1/watts") of a given sensor
+        (None for any sensor), `source.update(text)` will be called with the
+        field content.
+        """
+        self._routes[(sensor, field)].append(source)
+        self._parser.add_field(field)
 
-    def register_source(self, source):
-        self._sources.append(source)
+    def on_history(self, callback):
+        """ Callback called with (sensor id, data) for each history message
+        """
+        self._history_callbacks.append(callback)
+        self._parser.history = True
+
+    def handle_line(self, data):
+        """ Parse one XML message and dispatch it to the sources
+        """
+        ## remove "empty" char
+        data = data.replace(b"\x00", b"").strip()
+        if not data:
+            return
+        try:
+            record = self._parser.parse(data)
+        except ExpatError as err:
+            self._logger.error(str(err))
+            return
+        if record:
+            self.get_data(record)
 
     def start(self):
         if self.running:
@@ -35,72 +180,71 @@ class CurrentcostSerial(object):
         self.worker = gevent.spawn(self._loop)
 
     def _loop(self):
-        self._ser = serial.Serial(self._serial_dev, 57600)
+        # non blocking serial port, wait for data in the gevent hub
+        self._ser = serial.Serial(self._serial_dev, 57600, timeout=0)
+        buff = b""
         try:
             while True:
-                #print("CC loop")
-                if self._ser.inWaiting() > 0:
-                    data = self._ser.readline().strip()
-                    ## remove "empty" char
-                    data = data.replace("\x00", "")
-                    try:
-                        data = xmltodict.parse(data)
-                        self.get_data(data)
-                    except ExpatError as err:
-                        self._logger.error(str(err))
-                gevent.sleep(0.5)
+                wait_read(self._ser.fileno())
+                buff += self._ser.read(self._ser.inWaiting() or 1)
+                while b"\n" in buff:
+                    line, buff = buff.split(b"\n", 1)
+                    self.handle_line(line)
         finally:
             self._ser.close()
 
 
 class CurrentcostSource(DataSource):
-    def __init__(self, cc, name=None, unit=None):
+    field = None    # message field read by the source (ex: "ch1/watts")
+
+    def __init__(self, cc, name=None, unit=None, sensor=None, field=None):
+        """
+        :param sensor: radio sensor id (0 is the main one), None for any
+        """
         super(CurrentcostSource, self).__init__(name=name, unit=unit)
+        if field is not None:
+            self.field = field
+        self.sensor = sensor
         self._cc = cc
-        self._cc.register_source(self)
+        self._cc.register_source(self, self.field, sensor=sensor)
         self.error = "No data"
 
     def update(self, data):
-        pass
+        self._logger.debug("%s: get data (%s)", self.name, data)
+        try:
+            self.value = self.parse_data(data)
+            self.error = None
+        except ValueError:
+            self.error = "Invalid data"
+        except:
+            self.error = "Unknow error"
+
+    def parse_data(self, data):
+        return float(data)
 
     def start(self):
+        super(CurrentcostSource, self).start()
         # start client (if needed)
         self._cc.start()
 
 
 class CurrentcostWatts(CurrentcostSource):
 
-    def __init__(self, cc, name=None):
-        super(CurrentcostWatts, self).__init__(cc, name=name, unit="W")
-
-    def update(self, data):
-        data = data.get("msg", {}).get("ch1", {}).get("watts", None)
-        self._logger.info("%s: get data (%s)" % (self.name, data))
-        try:
-            self.value = float(data)
-            self.error = None
-        except ValueError:
-            self.error = "Invalid data"
-        except:
-            self.error = "Unknow error"
+    def __init__(self, cc, name=None, sensor=0, channel=1):
+        """
+        :param sensor: radio sensor id (0 to 9)
+        :param channel: clamp channel of the sensor (1 to 3)
+        """
+        field = "ch%d/watts" % channel
+        super(CurrentcostWatts, self).__init__(cc, name=name, unit="W", sensor=sensor, field=field)
 
 
 class CurrentcostTemp(CurrentcostSource):
+    field = "tmpr"
 
     def __init__(self, cc, name=None):
         super(CurrentcostTemp, self).__init__(cc, name=name, unit="°C")
 
-    def update(self, data):
-        data = data.get("msg", {}).get("tmpr", None)
-        self._logger.info("%s: get data (%s)" % (self.name, data))
-        try:
-            self.value = float(data)
-            self.error = None
-        except ValueError:
-            self.error = "Invalid data"
-        except:
-            self.error = "Unknow error"
-
 
 def main():
     def change_callback(src):
@@ -1,10 +1,170 @@
 #-*- coding:utf-8 -*-
+import os
 import sys
+import json
+import time
 import logging
+from datetime import datetime
+from collections import deque
+
+import gevent
+from gevent.event import Event
 
 from influxdb import InfluxDBClient as OriginalInfluxDBClient
 
+from gsensors.utils import ErrorReporter
+
+
+def to_epoch_ms(date):
+    """ Convert a (naive, local) datetime to milliseconds since epoch
+    """
+    return int(time.mktime(date.timetuple())*1000 + date.microsecond/1000)
+
+
+class InfluxDBBatchWriter(object):
+    """ Buffer points and write them by batch
+
+    Points are kept in a bounded in-memory buffer and are written by a
+    background greenlet either when `batch_size` points are waiting or when
+    the oldest one is older than `flush_interval` seconds.
+
+    If the database is not reachable, points are spilled (as JSON lines) to
+    `spill_path` (if given) and replayed once the database is back.
+    """
+    batch_size = 500        # write as soon as this many points are waiting
+    flush_interval = 5.     # max age (seconds) of a buffered point
+    max_buffer = 50000      # max nb of points kept in memory
+    retry_interval = 10.    # wait before retrying after a failed write
+
+    def __init__(self, influxdb, batch_size=None, flush_interval=None, max_buffer=None, spill_path=None):
+        self._logger = logging.getLogger("gsensors.InfluxDBBatchWriter")
+        self._reporter = ErrorReporter(self._logger)
+        self.influxdb = influxdb
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if max_buffer is not None:
+            self.max_buffer = max_buffer
+        self.spill_path = spill_path
+        self._buffer = deque(maxlen=self.max_buffer)
+        self._first_at = None       # time of the oldest buffered point
+        self._wakeup = Event()
+        self.worker = None
+        self.nb_written = 0
+        self.nb_dropped = 0
+        self.nb_spilled = 0
+
+    def add(self, point):
+        """ Add a point (dict as expected by `write_points`) to the buffer
+        """
+        if len(self._buffer) == self._buffer.maxlen:
+            self.nb_dropped += 1
+        self._buffer.append(point)
+        if self._first_at is None:
+            self._first_at = time.time()
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+        self.start()
+
+    def start(self):
+        if self.worker is None:
+            self.worker = gevent.spawn(self._loop)
+
+    def _loop(self):
+        while True:
+            timeout = self.flush_interval
+            if self._first_at is not None:
+                timeout = max(0, self._first_at + self.flush_interval - time.time())
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if not self._buffer:
+                continue
+            if not self.flush():
+                gevent.sleep(self.retry_interval)
+
+    def flush(self):
+        """ Write all buffered points, return False if the database is down
+        """
+        while self._buffer:
+            nb = min(self.batch_size, len(self._buffer))
+            batch = [self._buffer.popleft() for _ in range(nb)]
+            if not self._buffer:
+                self._first_at = None
+            if not self._write(batch):
+                self._spill(batch)
+                return False
+        return self._replay()
+
+    def _write(self, points):
+        try:
+            self.influxdb.write_points(points, time_precision="ms")
+        except Exception as err:
+            self._reporter.report("Write error", err)
+            return False
+        self._reporter.clear()
+        self.nb_written += len(points)
+        self._logger.debug("Write %d points" % len(points))
+        return True
+
+    def _spill(self, points):
+        """ Keep points that can not be written (on disk if possible)
+        """
+        if self.spill_path is None:
+            # put it back in the buffer, oldest points may be dropped
+            nb_free = self._buffer.maxlen - len(self._buffer)
+            self.nb_dropped += max(0, len(points) - nb_free)
+            self._buffer.extendleft(reversed(points[-nb_free:] if nb_free else []))
+            if self._buffer and self._first_at is None:
+                self._first_at = time.time()
+            return
+        with open(self.spill_path, "a") as spill_file:
+            for point in points:
+                spill_file.write(json.dumps(point) + "\n")
+        self.nb_spilled += len(points)
+        self._logger.warning("%d points spilled to %s" % (len(points), self.spill_path))
+
+    def _replay(self):
+        """ Write back points previously spilled on disk
+        """
+        if self.spill_path is None or not os.path.exists(self.spill_path):
+            return True
+        with open(self.spill_path) as spill_file:
+            points = [json.loads(line) for line in spill_file if line.strip()]
+        os.remove(self.spill_path)
+        self._logger.info("Replay %d spilled points" % len(points))
+        for start in range(0, len(points), self.batch_size):
+            batch = points[start:start + self.batch_size]
+            if not self._write(batch):
+                self._spill(points[start:])
+                return False
+        return True
+
+
+def get_writer(influxdb):
+    """ Get the batch writer associated to an InfluxDB client (shared by all
+    the InfluxDBPublish of this client)
+    """
+    writer = getattr(influxdb, "_batch_writer", None)
+    if writer is None:
+        writer = InfluxDBBatchWriter(influxdb)
+        influxdb._batch_writer = writer
+    return writer
+
+
 class InfluxDBClient(OriginalInfluxDBClient):
+    def __init__(self, *args, **kwargs):
+        writer_kwargs = {}
+        for key in ["batch_size", "flush_interval", "max_buffer", "spill_path"]:
+            if key in kwargs:
+                writer_kwargs[key] = kwargs.pop(key)
+        super(InfluxDBClient, self).__init__(*args, **kwargs)
+        self._batch_writer = InfluxDBBatchWriter(self, **writer_kwargs)
+
+    @property
+    def writer(self):
+        return get_writer(self)
+
     def Publish(self, measurement, tags):
         return InfluxDBPublish(self, measurement, tags)
 
@@ -14,21 +174,21 @@ class InfluxDBPublish(object):
     def __init__(self, influxdb, measurement, tags):
         assert(isinstance(influxdb, OriginalInfluxDBClient))
         self.influxdb = influxdb
+        self.writer = get_writer(influxdb)
         self.tags = tags
         self.measurement = measurement
         self._logger = logging.getLogger("gsensors.InfluxDBPublish")
 
     def __call__(self, source, value):
-        #TODO what when error ?
-        json_body = [
-            {
-                "measurement": self.measurement,
-                "tags": self.tags,
-                "fields": {
-                    "value": value
-                }
+        date = getattr(source, "last_update", None) or datetime.now()
+        point = {
+            "measurement": self.measurement,
+            "tags": self.tags,
+            "time": to_epoch_ms(date),
+            "fields": {
+                "value": value
             }
-        ]
-        self.influxdb.write_points(json_body)
-        self._logger.debug("Write for measurement '%s'" % self.measurement)
+        }
+        self.writer.add(point)
+        self._logger.debug("Buffer point for measurement '%s'" % self.measurement)
 
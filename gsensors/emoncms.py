@@ -7,11 +7,93 @@ from datetime import datetime, timedelta
 import time
 import calendar
 
-import requests
 import json
 import gevent
+from gevent.event import AsyncResult
+from gevent.pool import Pool
 
 from gsensors import AutoUpdateValue
+from gsensors.httppool import default_pool
+
+# local time offset can not change twice in less than that
+_MAX_SAME_OFFSET_HOURS = 7*24
+
+def _local_offsets(seconds):
+    """ Offset (in seconds) from UTC to local time for each timestamp
+
+    Offsets are computed once per distinct hour, and by bisection as they
+    only change on DST switches.
+    """
+    import numpy as np
+    hours, inverse = np.unique(seconds // 3600, return_inverse=True)
+    offsets = np.zeros(len(hours), dtype="int64")
+
+    def offset(num):
+        date = int(hours[num]) * 3600
+        return calendar.timegm(time.localtime(date)) - date
+
+    stack = [(0, len(hours) - 1)] if len(hours) else []
+    while stack:
+        low, high = stack.pop()
+        off_low, off_high = offset(low), offset(high)
+        if off_low == off_high and hours[high] - hours[low] < _MAX_SAME_OFFSET_HOURS:
+            offsets[low:high+1] = off_low
+        elif high - low <= 1:
+            offsets[low] = off_low
+            offsets[high] = off_high
+        else:
+            middle = (low + high) // 2
+            stack.append((low, middle))
+            stack.append((middle + 1, high))
+    return offsets[inverse]
+
+
+def to_arrays(data_brut):
+    """ Convert emoncms [[timestamp (ms), value], ...] data to numpy arrays
+
+    :return: local dates as `datetime64[ms]` array, values as `float64` array
+        (NaN for missing values)
+    """
+    import numpy as np
+    raw = np.array(data_brut, dtype="float64").reshape(-1, 2)
+    dates = raw[:, 0].astype("int64")
+    dates += _local_offsets(dates // 1000) * 1000
+    return dates.astype("datetime64[ms]"), raw[:, 1]
+
+
+def to_series(data_brut, name=None):
+    """ Convert emoncms [[timestamp (ms), value], ...] data to a pandas Series
+    indexed by local dates
+    """
+    import pandas as pd
+    dates, vals = to_arrays(data_brut)
+    return pd.Series(vals, index=pd.DatetimeIndex(dates), name=name)
+
+
+def _to_series_legacy(data_brut, name=None):
+    """ Previous (pure python) conversion, kept for benchmark
+    """
+    import pandas as pd
+    dates, vals = zip(*data_brut)
+    dates = [datetime.fromtimestamp(date/1000) for date in dates]
+    return pd.Series(vals, index=dates, name=name)
+
+
+def benchmark_conversion(sizes=(10000, 100000, 1000000), delta_sec=300):
+    """ Compare legacy and numpy conversion of fetched data
+    """
+    import random
+    t_start = (time.time() - max(sizes)*delta_sec) * 1000
+    for size in sizes:
+        data_brut = [[t_start + num*delta_sec*1000, random.random()] for num in range(size)]
+        for label, convert in [("legacy", _to_series_legacy), ("numpy", to_series)]:
+            begin_at = time.time()
+            convert(data_brut)
+            print("%8d points %-7s: %7.3fs" % (size, label, time.time() - begin_at))
+        begin_at = time.time()
+        to_arrays(data_brut)
+        print("%8d points %-7s: %7.3fs" % (size, "raw", time.time() - begin_at))
+
 
 class EmoncmsSource(AutoUpdateValue):
     update_freq = 30 # every minutes by default
@@ -28,7 +110,8 @@ class EmoncmsSource(AutoUpdateValue):
             "delta_sec": delta_sec,
             "nb_data": nb_data,
         }
-        self.checked_update()
+        self.plots.pop(plot_name, None)
+        self._checked_update()
 
     def update(self):
         values = self.emoncms_client.get_value(self.feedid)
@@ -38,8 +121,32 @@ class EmoncmsSource(AutoUpdateValue):
         # compute plots
         # FIXME: remove it ?
         for plot_name, plot_cfg in self.plots_cfg.iteritems():
-            # TODO check if update needed
-            self.plots[plot_name] = self.emoncms_client.get_data(fid=self.feedid, **plot_cfg)
+            self._update_plot(plot_name, **plot_cfg)
+
+    def _update_plot(self, plot_name, delta_sec, nb_data):
+        """ Fetch only the data newer than the last cached point
+        """
+        plot = self.plots.get(plot_name)
+        if plot is None or len(plot) == 0:
+            self.plots[plot_name] = self.emoncms_client.get_data(
+                fid=self.feedid, delta_sec=delta_sec, nb_data=nb_data
+            )
+            return
+        import pandas as pd
+        # the last point may be an incomplete average: fetch it again
+        last_date = plot.index[-1]
+        now = datetime.now()
+        if (now - last_date).total_seconds() < delta_sec:
+            return  # nothing new
+        nb_new = min(nb_data, int((now - last_date).total_seconds() // delta_sec) + 1)
+        tail = self.emoncms_client.get_data(
+            fid=self.feedid, delta_sec=delta_sec, start_date=last_date, nb_data=nb_new
+        )
+        if len(tail) == 0:
+            return
+        plot = pd.concat([plot[plot.index < last_date], tail[tail.index >= last_date]])
+        # evict from head
+        self.plots[plot_name] = plot[-nb_data:]
 
     def export(self):
         res = super(EmoncmsSource, self).export()
@@ -54,16 +161,28 @@ class EmoncmsSource(AutoUpdateValue):
 class EmoncmsClient(object):
     """ Get data from emoncms (>=8.5) API
     """
+    feeds_ttl = 30  # feed list is downloaded at most once every ... seconds
+    chunk_size = 800    # max nb of points asked in each request
+    max_parallel_chunks = 4 # max nb of requests made at once by `get_data`
 
-    def __init__(self, url, apikey=None):
+    def __init__(self, url, apikey=None, http=None):
+        """
+        :param http: :class:`HTTPPool` to use (shared one by default)
+        """
         self._logger = logging.getLogger("EmoncmsClient")
         self.url = url
         self.apikey = apikey
+        self.http = http or default_pool()
         self._tres = {}
+        # feed list cache
+        self._feeds = None
+        self._feeds_by_id = {}
+        self._feeds_time = 0
+        self._feeds_fetch = None    # AsyncResult of the running download
         # compute timeres
-        res = self._get_json(self.url + "/feed/list.json")
+        res = self.feeds()
         for feed in res:
-            fid = int(feed["id"])
+            fid = feed["id"]
             #self._tres[fid] = self._compute_time_res(fid)
 
     def publish(self, node, data):
@@ -75,13 +194,13 @@ class EmoncmsClient(object):
         params = self._default_params()
         params["node"] = node
         params["data"] = json.dumps(data)
-        results = requests.get(url, params=params)
+        results = self.http.get(url, params=params)
         assert results.text.strip() == "ok"
 
     def _get_json(self, url, params=None):
         if params is None:
             params = self._default_params()
-        results = requests.get(url, params=params)
+        results = self.http.get(url, params=params)
         # error if not 200 for HTTP status
         results.raise_for_status()
         if results.text == "false":
@@ -95,24 +214,49 @@ class EmoncmsClient(object):
             params["apikey"] = self.apikey
         return params
 
-    def feeds(self):
+    def feeds(self, max_age=None):
         """ Get data about all available feeds
+
+        The feed list is cached for `feeds_ttl` seconds (or `max_age` if
+        given), and concurrent callers share the same download.
         """
-        res = self._get_json(self.url + "/feed/list.json")
-        for feed in res:
-            feed[u"id"] = int(feed["id"])
-            feed[u"tres"] = self.time_res(feed["id"])
-            feed[u"date"] = datetime.fromtimestamp(feed["time"])
+        if max_age is None:
+            max_age = self.feeds_ttl
+        if self._feeds is not None and time.time() - self._feeds_time <= max_age:
+            return self._feeds
+        if self._feeds_fetch is not None:
+            # already downloading, wait for it
+            return self._feeds_fetch.get()
+        fetch = self._feeds_fetch = AsyncResult()
+        try:
+            res = self._get_json(self.url + "/feed/list.json")
+            for feed in res:
+                feed[u"id"] = int(feed["id"])
+                feed[u"tres"] = self.time_res(feed["id"])
+                feed[u"date"] = datetime.fromtimestamp(feed["time"])
+        except Exception as err:
+            fetch.set_exception(err)
+            raise
+        finally:
+            self._feeds_fetch = None
+        self._feeds = res
+        self._feeds_by_id = {feed["id"]: feed for feed in res}
+        self._feeds_time = time.time()
+        fetch.set(res)
         return res
 
+    def feed(self, fid):
+        """ Data about a given feed (from the cached feed list)
+        """
+        self.feeds()
+        if fid not in self._feeds_by_id:
+            raise ValueError("Feed not found")
+        return self._feeds_by_id[fid]
+
     def get_value(self, fid):
         """ return the last value of a field
         """
-        all_data = self.feeds()
-        all_data = {feed["id"]: feed for feed in all_data}
-        if fid not in all_data:
-            raise ValueError("Feed not found")
-        return all_data[fid]
+        return self.feed(fid)
 
     def time_res(self, fid):
         return self._tres.get(fid, None)
@@ -166,64 +310,83 @@ class EmoncmsClient(object):
             start_date = end_date - timedelta(0, nb_data*delta_sec)
         return delta_sec, start_date, nb_data
 
-    def get_data(self, fid, delta_sec, start_date=None, end_date=None, nb_data=None):
-        """
-        :param fid: feed ID to get
+    def _chunks(self, delta_sec, start_date, nb_data):
+        """ Split the time interval in (t_start, t_end) chunks (in ms) of at
+        most `chunk_size` points
         """
-        try:
-            import pandas as pd
-        except ImportError:
-            raise #TODO: manage error !
+        t_start = time.mktime( start_date.timetuple() )*1000
+        #t_start = calendar.timegm(start_date.timetuple())*1000
+        chunks = []
+        nb_read = 0
+        while nb_read < nb_data:
+            nb_to_read = min(self.chunk_size, nb_data-nb_read)
+            t_end = t_start + nb_to_read*delta_sec*1000
+            chunks.append((t_start, t_end))
+            nb_read += nb_to_read
+            t_start = t_end
+        return chunks
 
-        # search for feed
-        for feed in self.feeds():
-            if fid == feed['id']:
-                feed_name = feed['name']
-                break
-        else:
-            raise ValueError("Field %s is unknow" % fid)
+    def _get_chunk(self, fid, delta_sec, t_start, t_end):
+        query = self.url + "/feed/average.json"
+        params = self._default_params()
+        params["id"] = fid
+        params["start"] = "%d" % t_start
+        params["end"] = "%d" % t_end
+        params["interval"] = delta_sec
+        return self._get_json(query, params)
 
+    def iter_data(self, fid, delta_sec, start_date=None, end_date=None, nb_data=None, max_parallel=None):
+        """ Iterate over the data, chunk by chunk (in time order) as soon as
+        they are downloaded. Chunks are downloaded concurrently.
+
+        Each chunk is a list of [timestamp (ms), value] pairs.
+
+        :param max_parallel: max nb of chunks downloaded at once (default
+            `max_parallel_chunks`)
+        """
         delta_sec, start_date, nb_data = self._check_interval(
             delta_sec=delta_sec,
             start_date=start_date,
             end_date=end_date,
             nb_data=nb_data
         )
-        ## make the requests
-        t_start = time.mktime( start_date.timetuple() )*1000
-        #t_start = calendar.timegm(start_date.timetuple())*1000
-        
-        # get datas
+        chunks = self._chunks(delta_sec, start_date, nb_data)
+        pool = Pool(max_parallel or self.max_parallel_chunks)
+        last_date = None
+        try:
+            for data in pool.imap(lambda chunk: self._get_chunk(fid, delta_sec, *chunk), chunks):
+                # remove point duplicated at chunk boundary
+                if last_date is not None:
+                    data = [point for point in data if point[0] > last_date]
+                if data:
+                    last_date = data[-1][0]
+                yield data
+        finally:
+            pool.kill()
+
+    def get_data(self, fid, delta_sec, start_date=None, end_date=None, nb_data=None, max_parallel=None, raw=False):
+        """
+        :param fid: feed ID to get
+        :param max_parallel: max nb of requests made at once
+        :param raw: if True return (dates, values) numpy arrays (see
+            :func:`to_arrays`) instead of a pandas Series
+        """
+        # search for feed
+        try:
+            feed_name = self.feed(fid)['name']
+        except ValueError:
+            raise ValueError("Field %s is unknow" % fid)
+
         data_brut = []
-        nb_read = 0
-        nb_each_request = 800
-        while nb_read < nb_data:
-            # choix du pas de temps
-            nb_to_read = min(nb_each_request, nb_data-nb_read)
-            t_end = t_start + nb_to_read*delta_sec*1000
-            #rint  int( t_start ), int( t_end )
-            query = self.url + "/feed/average.json"
-            params = self._default_params()
-            params["id"] = fid
-            params["start"] = "%d" % t_start
-            params["end"] = "%d" % t_end
-            params["interval"] = delta_sec
-            
-            data_brut += self._get_json(query, params)
-#            if len(data_brut) < nb_to_read:
-#                has_min_res = ""
-#                if len(data_brut) >= 2:
-#                    min_res = (data_brut[1][0] - data_brut[0][0])/1000
-#                    has_min_res = " (min res: %ss)" % min_res
-#                raise ValueError("Get only %d data (/%d) too small temporal resolution%s" % (len(data_brut), nb_to_read, has_min_res))
-            nb_read += nb_to_read
-            t_start = data_brut[-1][0]
-        
+        chunks = self.iter_data(fid, delta_sec, start_date=start_date, end_date=end_date,
+            nb_data=nb_data, max_parallel=max_parallel)
+        for chunk in chunks:
+            data_brut += chunk
+
+        if raw:
+            return to_arrays(data_brut)
         ## convert it to panda
-        dates, vals = zip(*data_brut)
-        dates = [datetime.fromtimestamp(date/1000) for date in dates]
-        ts = pd.Series(vals, index=dates, name=feed_name)
-        return ts
+        return to_series(data_brut, name=feed_name)
 
 
 
@@ -238,9 +401,14 @@ def main():
         help="API key (get public data if not given)", default=None
     )
     parser.add_argument("-f", "--feed-id", action='store', type=int, help="Feed ID")
+    parser.add_argument("--bench", action='store_true', help="Benchmark data conversion")
 
     args = parser.parse_args()
 
+    if args.bench:
+        benchmark_conversion()
+        return 0
+
     # Build emoncms data source object
     emon_src = EmoncmsSource(args.url, apikey=args.api_key)
 
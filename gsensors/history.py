@@ -0,0 +1,108 @@
+#-*- coding:utf-8 -*-
+""" Fixed memory value history with running aggregates
+"""
+import time
+from array import array
+from collections import deque
+
+
+class ValueHistory(object):
+    """ Last `size` (timestamp, value) pairs of a source, optionally limited to
+    the last `window` seconds.
+
+    Values are stored in array backed ring buffers. Sum, min and max are
+    maintained on each append (min/max with monotonic deques), so aggregates
+    are available without rescanning the data.
+    """
+    def __init__(self, size, window=None):
+        """
+        :param size: max nb of values kept
+        :param window: max age (seconds) of the values kept (None for no limit)
+        """
+        self.size = size
+        self.window = window
+        self._times = array("d", [0.]) * size
+        self._values = array("d", [0.]) * size
+        # points are numbered, the ones from _start to _end-1 are kept
+        self._start = 0
+        self._end = 0
+        self._sum = 0.
+        self._mins = deque()    # nums of points with increasing values
+        self._maxs = deque()    # nums of points with decreasing values
+
+    def __len__(self):
+        return self._end - self._start
+
+    def append(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        size = self.size
+        values = self._values
+        if self._end - self._start == size:
+            self._pop()
+        num = self._end
+        self._times[num % size] = timestamp
+        values[num % size] = value
+        self._sum += value
+        mins = self._mins
+        while mins and values[mins[-1] % size] >= value:
+            mins.pop()
+        mins.append(num)
+        maxs = self._maxs
+        while maxs and values[maxs[-1] % size] <= value:
+            maxs.pop()
+        maxs.append(num)
+        self._end += 1
+        self.expire(timestamp)
+
+    def _pop(self):
+        """ Remove the oldest point
+        """
+        num = self._start
+        self._sum -= self._values[num % self.size]
+        if self._mins[0] == num:
+            self._mins.popleft()
+        if self._maxs[0] == num:
+            self._maxs.popleft()
+        self._start += 1
+        if self._start == self._end:
+            self._sum = 0.  # avoid float error accumulation
+
+    def expire(self, now=None):
+        """ Remove the points older than `window`
+        """
+        if self.window is None:
+            return
+        if now is None:
+            now = time.time()
+        limit = now - self.window
+        while self._start < self._end and self._times[self._start % self.size] < limit:
+            self._pop()
+
+    @property
+    def min(self):
+        return self._values[self._mins[0] % self.size] if self._mins else None
+
+    @property
+    def max(self):
+        return self._values[self._maxs[0] % self.size] if self._maxs else None
+
+    @property
+    def mean(self):
+        return self._sum / len(self) if len(self) else None
+
+    def items(self):
+        """ Kept (timestamp, value) pairs, oldest first
+        """
+        size = self.size
+        return [(self._times[num % size], self._values[num % size]) for num in range(self._start, self._end)]
+
+    def aggregates(self):
+        self.expire()
+        res = {}
+        res["count"] = len(self)
+        res["min"] = self.min
+        res["max"] = self.max
+        res["mean"] = self.mean
+        res["window"] = self.window
+        return res
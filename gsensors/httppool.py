@@ -0,0 +1,90 @@
+#-*- coding:utf-8 -*-
+""" Shared HTTP layer for polled sources
+
+Keep one keep-alive `requests.Session` per host and (optionally) run the
+requests in a bounded thread pool so that they never block the gevent hub,
+even if `socket` is not monkey patched.
+"""
+import logging
+import threading
+
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+import gevent.monkey
+from gevent.threadpool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HTTPPool(object):
+    timeout = 10        # default timeout (seconds) of each request
+    pool_maxsize = 10   # max nb of kept-alive connections per host
+    max_workers = 10    # size of the thread pool
+
+    def __init__(self, timeout=None, pool_maxsize=None, max_workers=None, use_threads=None):
+        """
+        :param use_threads: run requests in a thread pool, by default only if
+            `socket` is not monkey patched by gevent.
+        """
+        self._logger = logging.getLogger("gsensors.HTTPPool")
+        if timeout is not None:
+            self.timeout = timeout
+        if pool_maxsize is not None:
+            self.pool_maxsize = pool_maxsize
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if use_threads is None:
+            use_threads = not gevent.monkey.is_module_patched("socket")
+        self.use_threads = use_threads
+        self._threadpool = None
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        """ Get the keep-alive session for the host of the url
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self._lock:
+            if key not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount("%s://" % parts.scheme, adapter)
+                self._sessions[key] = session
+            return self._sessions[key]
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        session = self.session(url)
+        if not self.use_threads:
+            return session.request(method, url, **kwargs)
+        if self._threadpool is None:
+            self._threadpool = ThreadPool(self.max_workers)
+        return self._threadpool.apply(session.request, (method, url), kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+_default_pool = None
+
+def default_pool():
+    """ HTTP pool shared by all the sources that do not get one explicitly
+    """
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = HTTPPool()
+    return _default_pool
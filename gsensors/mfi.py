@@ -10,17 +10,18 @@ from collections import defaultdict
 import gevent
 import gevent.monkey
 gevent.monkey.patch_all()   # needed for websocket
+from gevent.pool import Pool
 
 import random
 import json
 
-import requests
 from requests.exceptions import TooManyRedirects
 
 from ws4py.client import WebSocketBaseClient
 
 from gsensors.basic import DataSource
-from gsensors.utils import full_exc_info
+from gsensors.httppool import default_pool
+from gsensors.utils import ErrorReporter
 
 
 class MFIConnectionError(RuntimeError):
@@ -42,6 +43,7 @@ class MFIWebSocketClient(WebSocketBaseClient):
 
     def closed(self, code, reason=None):
         self._logger.warning("connection closed (%s - %s)" % (code, reason))
+        self.mfi_device.ws_closed(self)
 
     def received_message(self, msg):
         try:
@@ -59,26 +61,60 @@ class MFIWebSocketClient(WebSocketBaseClient):
 
 
 
+_MISSING = object()
+
+
 class MFIDevice(object):
+    """ mFi device (mPower)
 
-    get_update_freq = 15 # Update data with a full HTTP GET every... (in seconds)
+    Data are pushed by the device over a websocket, a full HTTP GET is only
+    done on (re)connection or when the websocket is silent for more than
+    `ws_timeout` seconds. If it stays silent twice that time, it is
+    reconnected.
+    """
+    ws_timeout = 30     # resync (HTTP GET) if no websocket data since... (in seconds)
+    watchdog_freq = 5   # check websocket health every... (in seconds)
+    # retry delay after a failure: min(retry_max, retry_min * 2**nb_failures)
+    retry_min = 1.
+    retry_max = 300.
 
     #doc de l'API:
     # http://community.ubnt.com/t5/mFi/mPower-mFi-Switch-and-mFi-In-Wall-Outlet-HTTP-API/td-p/1076449
-    def __init__(self, host, user, password):
+    def __init__(self, host, user, password, http=None, supervisor=None):
+        """
+        :param supervisor: :class:`MFISupervisor` managing the device
+            (shared default one if None)
+        """
         self._logger = logging.getLogger("gsensors.mfi.MFIDevice")
+        self._reporter = ErrorReporter(self._logger)
+        self.http = http or default_pool()
         self._host = host
         self._user = user
         self._password = password
         self._ws = None   # WebSocket client
+        self._ws_ok = False
+        self._last_ws = 0       # time of last websocket data
+        self._last_resync = 0   # time of last full HTTP GET
         self.running = False
         self._token = None
-        self._sources = defaultdict(list)
+        self._sources = defaultdict(list)  # (port, field) -> sources
+        self._port_sources = defaultdict(list)  # port -> sources (any field)
         self.data_sensors = {}
-        self.login()
-
-    def register_source(self, port, source):
-        self._sources[port].append(source)
+        self.supervisor = supervisor
+        # supervision state and stats
+        self.nb_failures = 0    # consecutive failures
+        self.next_try = 0       # time before which nothing should be tried
+        self.last_check = 0
+        self.nb_reconnects = 0
+        self.latency = None     # duration of last HTTP GET (seconds)
+
+    def register_source(self, port, source, field=None):
+        """ `source.update(value)` will be called when the `field` of the
+        `port` changes, or with a {"_source": ..., "sensor": port data} dict
+        on any change if `field` is None
+        """
+        self._sources[(port, field)].append(source)
+        self._port_sources[port].append(source)
 
     @property
     def url(self):
@@ -102,14 +138,14 @@ class MFIDevice(object):
             "username": self._user,
             "password": self._password,
         }
-        res = requests.post(self.url + "/login.cgi", data, cookies=self.cookies)
+        res = self.http.post(self.url + "/login.cgi", data, cookies=self.cookies)
 
     def logout(self):
-        requests.get(self.url + "/logout.cgi", cookies=self.cookies)
+        self.http.get(self.url + "/logout.cgi", cookies=self.cookies)
 
     def get_json(self):
         try:
-            res = requests.get(self.url + "/sensors", cookies=self.cookies, timeout=3)
+            res = self.http.get(self.url + "/sensors", cookies=self.cookies, timeout=3)
         except TooManyRedirects:
             raise MFIConnectionError()
         ## convert to KwH
@@ -160,107 +196,245 @@ class MFIDevice(object):
         return _action
 
     def incoming_ws_data(self, data):
-        data["_source"] = "ws"  #indicate it come's from web socket
-        self._incoming_data(data)
+        self._last_ws = time()
+        self._incoming_data(data, "ws")    # comes from web socket
+
+    def ws_closed(self, ws):
+        if ws is self._ws:
+            self._ws_ok = False
 
     def incoming_data(self, data):
-        data["_source"] = "get"  #indicate it come's from http GRY
-        self._incoming_data(data)
-
-    def _incoming_data(self, data):
-        ports = [(sensor["port"], sensor) for sensor in data["sensors"]]
-        for port, sensor_values in ports:
-            if port in self.data_sensors:
-                self.data_sensors[port].update(sensor_values)
-            else:
-                self.data_sensors[port] = sensor_values
-            for source in self._sources[port]:
-                _data = {}
-                _data["_source"] = data["_source"]
-                _data["sensor"] = sensor_values
-                source.update(_data)
-
-    def _update(self):
-        self._ws = MFIWebSocketClient(self)
-        self._ws.connect()
-        while True:
-            sleep_time = self.get_update_freq
-            begin_at = time()
+        self._incoming_data(data, "get")   # comes from http GET
+
+    def _incoming_data(self, data, origin):
+        sources = self._sources
+        for sensor_values in data["sensors"]:
+            port = sensor_values["port"]
+            current = self.data_sensors.get(port)
+            if current is None:
+                current = self.data_sensors[port] = {}
+            changed = False
+            for field, value in sensor_values.items():
+                if current.get(field, _MISSING) == value:
+                    continue
+                current[field] = value
+                changed = True
+                for source in sources.get((port, field), ()):
+                    source.update(value)
+            if changed:
+                port_sources = sources.get((port, None))
+                if port_sources:
+                    # one snapshot per port, `current` is updated in place
+                    port_data = {"_source": origin, "sensor": dict(current)}
+                    for source in port_sources:
+                        source.update(port_data)
+            # the port is alive even if nothing changed: restart timeouts
+            for source in self._port_sources.get(port, ()):
+                source._keep_alive()
+
+    def resync(self):
+        """ Get all the data with a full HTTP GET
+        """
+        begin_at = time()
+        data = self.get_json()
+        self._last_resync = time()
+        self.latency = self._last_resync - begin_at
+        self.incoming_data(data)
+        self._logger.debug("GET updated in %1.2fsec" % self.latency)
+
+    def reconnect(self):
+        """ (Re)login, open the websocket and resync
+        """
+        if self._ws is not None:
+            self._ws_ok = False
             try:
-                data = self.get_json()
-                self.incoming_data(data)
-            except MFIConnectionError:
-                self._logger.warning("connection error")
-                # reconnect
                 self._ws.close()
-                self.login()
-                self._ws = MFIWebSocketClient(self)
-                self._ws.connect()
-                sleep_time = .05 # retry quickly
             except Exception as err:
+                self._logger.debug("websocket close error: %s" % err)
+        self.nb_reconnects += 1
+        self.login()
+        self._ws = MFIWebSocketClient(self)
+        self._ws.connect()
+        self._ws_ok = True
+        self._last_ws = time()
+        self.resync()
+
+    def needed_action(self, now):
+        """ Method to call to keep the device synchronised (or None)
+        """
+        if now < self.next_try or now - self.last_check < self.watchdog_freq:
+            return None
+        self.last_check = now
+        silence = now - self._last_ws
+        if self._ws is None:
+            return self.reconnect
+        elif not self._ws_ok:
+            self._logger.warning("websocket closed, reconnect")
+            return self.reconnect
+        elif silence > 2 * self.ws_timeout:
+            self._logger.warning("no websocket data since %ds, reconnect" % silence)
+            return self.reconnect
+        elif silence > self.ws_timeout and self._last_resync < self._last_ws + self.ws_timeout:
+            self._logger.info("no websocket data since %ds, resync" % silence)
+            return self.resync
+        return None
+
+    def run_action(self, action):
+        """ Run a synchronisation action, with backoff on failure
+        """
+        try:
+            action()
+        except Exception as err:
+            if isinstance(err, MFIConnectionError):
+                self._logger.warning("connection error")
+            else:
                 #TODO indicate error to sources
-                #self._logger.error("update error: %s" % err)
-                self._logger.error("update error: %s" % err, exc_info=full_exc_info())
-            self._logger.debug("GET updated in %1.2fsec" % (time()-begin_at))
-            sleep_time = max(0.01, sleep_time - (time()-begin_at))
-            gevent.sleep(sleep_time)
+                self._reporter.report("update error", err)
+            self._ws_ok = False
+            delay = min(self.retry_max, self.retry_min * 2 ** min(self.nb_failures, 30))
+            self.nb_failures += 1
+            self.next_try = time() + delay
+        else:
+            self.nb_failures = 0
+            self._reporter.clear()
+
+    def stats(self):
+        res = {}
+        res["host"] = self._host
+        res["connected"] = self._ws_ok
+        res["latency"] = self.latency
+        res["nb_reconnects"] = self.nb_reconnects
+        res["nb_failures"] = self.nb_failures
+        res["last_ws_data"] = self._last_ws or None
+        return res
 
     def start(self):
         if not self.running:
-            gevent.spawn(self._update)
             self.running = True
+            supervisor = self.supervisor or default_supervisor()
+            supervisor.add(self)
+            supervisor.start()
+
+
+class MFISupervisor(object):
+    """ Keep many MFI devices connected from a single greenlet
+
+    Logins, reconnections and resyncs are done lazily and concurrently (at
+    most `max_concurrent` at once), with a per device backoff on failure, so
+    an unreachable device never blocks the others.
+    """
+    check_freq = 1.         # seconds between two checks of the devices
+    max_concurrent = 10     # max nb of devices synchronised at once
+
+    def __init__(self, http=None, max_concurrent=None):
+        self._logger = logging.getLogger("gsensors.mfi.MFISupervisor")
+        self.http = http or default_pool()
+        if max_concurrent is not None:
+            self.max_concurrent = max_concurrent
+        self.devices = []
+        self._busy = set()      # devices with a running action
+        self._pool = Pool(self.max_concurrent)
+        self.worker = None
+
+    def device(self, host, user, password):
+        """ Create a device managed by this supervisor (with shared HTTP pool)
+        """
+        device = MFIDevice(host, user, password, http=self.http, supervisor=self)
+        self.add(device)
+        return device
+
+    def add(self, device):
+        if device not in self.devices:
+            device.supervisor = self
+            self.devices.append(device)
+
+    def start(self):
+        if self.worker is None:
+            self.worker = gevent.spawn(self._loop)
+
+    def _loop(self):
+        while True:
+            now = time()
+            for device in self.devices:
+                if device in self._busy:
+                    continue
+                action = device.needed_action(now)
+                if action is not None:
+                    self._busy.add(device)
+                    self._pool.spawn(self._run, device, action)
+            gevent.sleep(self.check_freq)
+
+    def _run(self, device, action):
+        try:
+            device.run_action(action)
+        finally:
+            self._busy.discard(device)
+
+    def stats(self):
+        """ Per device connection stats
+        """
+        return [device.stats() for device in self.devices]
+
+
+_default_supervisor = None
+
+def default_supervisor():
+    """ Supervisor of the devices not attached to a given one
+    """
+    global _default_supervisor
+    if _default_supervisor is None:
+        _default_supervisor = MFISupervisor()
+    return _default_supervisor
 
 
 class MFISource(DataSource):
     """ Data Source from MFI device
+
+    Updated with the value of `field` of the port when it changes, or if
+    `field` is None with {"_source": "ws" or "get", "sensor": port data}
+    when any field of the port changes.
     """
+    field = None
+
     def __init__(self, mfi_device, port, name=None, unit=None, timeout=None):
         super(MFISource, self).__init__(name=name, unit=unit, timeout=timeout)
         self.mfi_device = mfi_device
         self.port = port
-        self.mfi_device.register_source(self.port, self)
+        self.mfi_device.register_source(self.port, self, field=self.field)
         self.error = "No data"
 
-    def start(self):
-        self.mfi_device.start()
-
     def update(self, data):
-        self._logger.info("%s: get data (%s)" % (self.name, data["_source"]))
-        #For now only keep WS data
-        if data["_source"] != "ws":
-            return
+        self._logger.debug("%s: get data (%s)", self.name, data)
         try:
             self.value = self.parse_data(data)
             self.error = None
-        except KeyError, ValueError:
+        except (KeyError, ValueError):
             self.error = "Invalid data"
         except:
             self.error = "Unknow error"
 
     def start(self):
+        super(MFISource, self).start()
         # start client (if needed)
         self.mfi_device.start()
 
     def parse_data(self, data):
-        """ Should be overriden
+        """ Should be overriden, `data` is the field value, or the dict
+        described above if `field` is None (ex: data["sensor"]["power"])
         """
         return data
 
 
 class MFIPower(MFISource):
-    def parse_data(self, data):
-        return data["sensor"]["power"]
+    field = "power"
 
 class MFIPowerFactor(MFISource):
-    def parse_data(self, data):
-        return data["sensor"]["powerfacor"]
+    field = "powerfactor"
 
 class MFIVoltage(MFISource):
-    def parse_data(self, data):
-        return data["sensor"]["voltage"]
+    field = "voltage"
 
 class MFIOutput(MFISource):
-    def parse_data(self, data):
-        return data["sensor"]["output"]
+    field = "output"
 
 
@@ -3,18 +3,155 @@
 """
 # a lot of good note about MQTT:
 # http://www.hivemq.com/mqtt-essentials-wrap-up/
+import time
+import json
+import struct
+import random
 import logging
 from datetime import datetime
 import socket
+from collections import OrderedDict
 
 import gevent
-from paho.mqtt.client import Client
+from gevent.select import select
+from gevent.event import Event
+from paho.mqtt.client import Client, MQTT_ERR_SUCCESS
 
 from gsensors.basic import DataSource
+from gsensors.basic import benchmark as basic_benchmark
+
+
+class TopicTrie(object):
+    """ Store objects by topic filter (with `+` and `#` wildcards) and find
+    all the ones matching a topic in O(topic depth)
+    """
+    def __init__(self):
+        self._root = {}     # level -> node, node: {"children": {}, "values": []}
+
+    @staticmethod
+    def _new_node():
+        return {"children": {}, "values": []}
+
+    @staticmethod
+    def check_filter(topic_filter):
+        levels = topic_filter.split("/")
+        for num, level in enumerate(levels):
+            if "#" in level and (level != "#" or num != len(levels) - 1):
+                raise ValueError("'#' should be the last level of the filter: %s" % topic_filter)
+            if "+" in level and level != "+":
+                raise ValueError("'+' should take a full level of the filter: %s" % topic_filter)
+        return levels
+
+    def add(self, topic_filter, value):
+        children = self._root
+        node = None
+        for level in self.check_filter(topic_filter):
+            node = children.setdefault(level, self._new_node())
+            children = node["children"]
+        node["values"].append(value)
+
+    def get(self, topic_filter):
+        """ Values registered with exactly this filter
+        """
+        children = self._root
+        node = None
+        for level in topic_filter.split("/"):
+            node = children.get(level)
+            if node is None:
+                return []
+            children = node["children"]
+        return node["values"]
+
+    def __contains__(self, topic_filter):
+        return len(self.get(topic_filter)) > 0
+
+    def match(self, topic):
+        """ All values whose filter matches the topic
+        """
+        levels = topic.split("/")
+        result = []
+        # '$' topics are not matched by wildcards on first level
+        wildcards = not topic.startswith("$")
+        stack = [(self._root, 0)]
+        while stack:
+            children, depth = stack.pop()
+            if wildcards or depth > 0:
+                node = children.get("#")
+                if node is not None:
+                    result.extend(node["values"])
+            if depth == len(levels):
+                continue
+            last = depth + 1 == len(levels)
+            for key in (levels[depth], "+"):
+                if key == "+" and not (wildcards or depth > 0):
+                    continue
+                node = children.get(key)
+                if node is None:
+                    continue
+                if last:
+                    result.extend(node["values"])
+                    # 'a/#' also matches 'a'
+                    node_all = node["children"].get("#")
+                    if node_all is not None:
+                        result.extend(node_all["values"])
+                else:
+                    stack.append((node["children"], depth + 1))
+        return result
+
+    def filters(self):
+        """ All registered filters
+        """
+        return [topic_filter for topic_filter, _ in self._walk(self._root, [])]
+
+    def _walk(self, children, prefix):
+        for level, node in children.items():
+            path = prefix + [level]
+            if node["values"]:
+                yield "/".join(path), node
+            for item in self._walk(node["children"], path):
+                yield item
+
+    def coalesced_filters(self, threshold, min_depth=1):
+        """ Registered filters where each group of at least `threshold`
+        filters sharing a common prefix (of at least `min_depth` levels) is
+        replaced by a single 'prefix/#' filter.
+        """
+        result = []
+        self._coalesce(self._root, [], threshold, min_depth, result)
+        return result
+
+    def _coalesce(self, children, prefix, threshold, min_depth, result):
+        for level, node in children.items():
+            path = prefix + [level]
+            if len(path) >= min_depth and level not in ("+", "#"):
+                nb_filters = sum(1 for _ in self._walk(node["children"], path))
+                if nb_filters >= threshold:
+                    result.append("/".join(path + ["#"]))
+                    continue
+            if node["values"]:
+                result.append("/".join(path))
+            self._coalesce(node["children"], path, threshold, min_depth, result)
+
+
+# payload types accepted by paho
+_PAYLOAD_TYPES = (bytes, bytearray, type(u""), int, float)
+
 
 class PipaMQTTClient(object): 
+    misc_interval = 1.  # keepalive/retry check period (seconds)
+    # subscribe 'prefix/#' instead of each topic when at least this number of
+    # topics share the same prefix (None: disabled, as the prefix may also
+    # cover topics published by this client or unrelated retained messages)
+    coalesce_threshold = None
+    coalesce_min_depth = 2  # never coalesce on less levels than that
+    max_queue = 1000    # max nb of messages waiting to be published
+    publish_batch = 100 # max nb of messages published per loop iteration
+    # reconnection delay: random in [0, min(reconnect_max, reconnect_min * 2**attempt)]
+    reconnect_min = 1.
+    reconnect_max = 120.
+    connack_timeout = 10.   # max wait of broker answer after connection
 
-    def __init__(self, client_id, host, port=1883, **kwargs):
+    def __init__(self, client_id, host, port=1883, coalesce_threshold=None, **kwargs):
         self._logger = logging.getLogger("gsensors.PipaMQTTClient")
         self._host = host
         self._port = port
@@ -25,17 +162,97 @@ class PipaMQTTClient(object):
 
         self.worker = None
         self.worker_runner = None
-        self.topics_sources = {}
+        self.topics_sources = TopicTrie()
+        self._subscribed = []   # topic filters currently subscribed
+        if coalesce_threshold is not None:
+            self.coalesce_threshold = coalesce_threshold
         self.running = False
         self.connected = False
+        self._connected_event = Event()
+        # outbound queue: key -> (topic, payload, qos, retain), key is the
+        # topic for coalesced messages, a sequence number else
+        self._outbox = OrderedDict()
+        self._outbox_seq = 0
+        self._flush_scheduled = False
+        self.nb_sent = 0
+        self.nb_dropped = 0
+        self.nb_coalesced = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False, coalesce=None):
+        """ Queue a message, it is sent as soon as the client is connected
 
-    def publish(self, topic, payload=None, qos=0, retain=False):
-        # check connected
-        if not self.connected:
-            raise RuntimeError("MQTT client not connected ! ")
-        if not self.running:
-            raise RuntimeError("MQTT client not running ! ")
-        self._mqtt_client.publish(topic, payload=payload, qos=qos, retain=retain)
+        :param coalesce: only keep the last queued payload for this topic
+            (default for retained messages)
+
+        Invalid messages are rejected here (ValueError or TypeError, as
+        paho would), not when the queue is flushed.
+        """
+        if not topic or "+" in topic or "#" in topic:
+            raise ValueError("Invalid topic: %r" % (topic,))
+        if qos not in (0, 1, 2):
+            raise ValueError("Invalid QoS level: %r" % (qos,))
+        if payload is not None and not isinstance(payload, _PAYLOAD_TYPES):
+            raise TypeError("payload must be a string, bytearray, int, float or None")
+        if coalesce is None:
+            coalesce = retain
+        if coalesce:
+            key = topic
+            if key in self._outbox:
+                self.nb_coalesced += 1
+        else:
+            self._outbox_seq += 1
+            key = self._outbox_seq
+        if key not in self._outbox and len(self._outbox) >= self.max_queue:
+            # drop the oldest message
+            self._outbox.popitem(last=False)
+            self.nb_dropped += 1
+        self._outbox[key] = (topic, payload, qos, retain)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        """ Flush the queue from a greenlet started at the next hub iteration
+        (so messages published in a row are sent together)
+        """
+        if self._flush_scheduled or not self.connected:
+            return
+        self._flush_scheduled = True
+        gevent.spawn(self._flush_outbox)
+
+    def _flush_outbox(self):
+        self._flush_scheduled = False
+        client = self._mqtt_client
+        nb_sent = 0
+        while self._outbox and self.connected and nb_sent < self.publish_batch:
+            key = next(iter(self._outbox))
+            topic, payload, qos, retain = self._outbox[key]
+            try:
+                result = client.publish(topic, payload=payload, qos=qos, retain=retain)
+            except (TypeError, ValueError) as err:
+                # invalid message, never sendable: drop it
+                self._logger.error("Drop message for '%s': %s" % (topic, err))
+                del self._outbox[key]
+                self.nb_dropped += 1
+                continue
+            if result[0] != MQTT_ERR_SUCCESS:
+                # not connected anymore, keep it for later
+                self._logger.warning("publish failed (%s), keep %d messages queued" % (result[0], len(self._outbox)))
+                return
+            del self._outbox[key]
+            nb_sent += 1
+        self.nb_sent += nb_sent
+        # send it now, the loop only waits for write readiness when needed
+        if client.want_write():
+            client.loop_write()
+        if self._outbox:
+            self._schedule_flush()
+
+    def queue_stats(self):
+        res = {}
+        res["depth"] = len(self._outbox)
+        res["sent"] = self.nb_sent
+        res["dropped"] = self.nb_dropped
+        res["coalesced"] = self.nb_coalesced
+        return res
 
     def PublishAction(self, topic, payload=None, retain=False):
         if payload is None:
@@ -52,48 +269,94 @@ class PipaMQTTClient(object):
     def on_disconnect(self, client, userdata, rc):
         self._logger.error("Disconnected with result code: "+str(rc))
         self.connected = False
-        self.connect()
+        self._connected_event.clear()
+        if self.running:
+            # random first delay, to not have all clients reconnecting at once
+            self.connect(first_delay=random.uniform(0, self.reconnect_min))
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             self._logger.info("Connected to MQTT broker")
             self.connected = True
+            self._connected_event.set()
             # Subscribing in on_connect() means that if we lose the connection and
             # reconnect then subscriptions will be renewed.
             #client.subscribe("$SYS/#")
             #client.subscribe("#")
-            for topic in self.topics_sources.keys():
-                client.subscribe(topic)
+            subscriptions = self.subscriptions()
+            if flags.get("session present") and subscriptions == self._subscribed:
+                # the broker kept our (clean_session=False) subscriptions
+                self._logger.debug("Session resumed, no need to subscribe")
+            elif subscriptions:
+                # a single SUBSCRIBE for all topics
+                client.subscribe([(topic, 0) for topic in subscriptions])
+            self._subscribed = subscriptions
+            # send messages queued while disconnected
+            self._schedule_flush()
         else:
             self._logger.error("Connection fail with error: %s" % rc)
 
     def on_message(self, client, userdata, msg):
-        self._logger.debug("get a msg %s: %s" % (msg.topic, msg.payload))
-        if msg.topic in self.topics_sources:
-            source = self.topics_sources[msg.topic]
+        self._logger.debug("get a msg %s: %s", msg.topic, msg.payload)
+        for source in self.topics_sources.match(msg.topic):
             source.update(msg)
 
+    def subscriptions(self):
+        """ Topic filters to subscribe to get all the registered topics
+        """
+        if self.coalesce_threshold is None:
+            return self.topics_sources.filters()
+        return self.topics_sources.coalesced_filters(self.coalesce_threshold, self.coalesce_min_depth)
+
+    def _is_subscribed(self, topic):
+        """ Whether topic is already covered by a current subscription
+        """
+        for sub in self._subscribed:
+            if sub == topic or (sub.endswith("/#") and (topic + "/").startswith(sub[:-1])):
+                return True
+        return False
+
     def register_source(self, source, topic):
-        # check that topic has no wildcard
-        assert "#" not in topic
+        """ Register a source for a topic (that may contain '+' or '#'
+        wildcards), `source.update(msg)` will be called on each message.
+        """
         if topic in self.topics_sources:
             raise ValueError("topic already monitored")
-        self.topics_sources[topic] = source
-        self._mqtt_client.subscribe(topic)
+        self.topics_sources.add(topic, source)
+        if self.connected and not self._is_subscribed(topic):
+            self._mqtt_client.subscribe(topic)
+            self._subscribed.append(topic)
         return source
 
-    def connect(self):
-        self.worker_runner = gevent.spawn(self._connect)
+    def connect(self, first_delay=0):
+        # only one connection greenlet at a time
+        if self.worker_runner is not None and not self.worker_runner.dead:
+            return
+        self.worker_runner = gevent.spawn(self._connect, first_delay)
+
+    def _reconnect_delay(self, attempt):
+        """ Exponential backoff with full jitter
+        """
+        max_delay = min(self.reconnect_max, self.reconnect_min * 2 ** min(attempt, 30))
+        return random.uniform(0, max_delay)
 
-    def _connect(self):
-        while not self.connected:
+    def _connect(self, first_delay=0):
+        gevent.sleep(first_delay)
+        attempt = 0
+        while self.running and not self.connected:
             try:
                 #self._mqtt_client.reinitialise()
                 self._mqtt_client.connect(host=self._host, port=self._port, keepalive=60)
             except socket.error as err:
                 self._logger.error("Imposible to connect to MQTT: %s" % err)
-                self._logger.info("Will retry in 2 seconds")
-            gevent.sleep(2)
+            else:
+                # wait for broker answer (see on_connect)
+                if self._connected_event.wait(self.connack_timeout):
+                    break
+            delay = self._reconnect_delay(attempt)
+            attempt += 1
+            self._logger.info("Will retry in %1.1f seconds" % delay)
+            gevent.sleep(delay)
 
     def wait_connected(self):
         while not self.connected:
@@ -107,50 +370,203 @@ class PipaMQTTClient(object):
         self.connect()
 
     def _mqtt_loop(self):
+        """ Wait for socket readiness (in the gevent hub) and run paho
+        read/write/misc steps only when needed
+        """
+        client = self._mqtt_client
+        last_misc = time.time()
         while self.running:
-            self._mqtt_client.loop(timeout=0.02)
-            gevent.sleep(0.01)
+            sock = client.socket()
+            if sock is None:
+                # not connected (yet)
+                gevent.sleep(self.misc_interval)
+                continue
+            timeout = max(0, last_misc + self.misc_interval - time.time())
+            wlist = [sock] if client.want_write() else []
+            try:
+                readable, writable, _ = select([sock], wlist, [], timeout)
+            except (socket.error, ValueError) as err:
+                # socket closed meanwhile
+                self._logger.debug("select error: %s" % err)
+                readable, writable = [], []
+            if readable:
+                client.loop_read()
+            if writable:
+                client.loop_write()
+            if time.time() - last_misc >= self.misc_interval:
+                client.loop_misc()
+                last_misc = time.time()
+
+
+## Payload decoders
+# a decoder factory takes the decoder options and returns a function
+# payload -> value, so the decoder is built once per source
+
+def _raw_decoder():
+    return lambda payload: payload
+
+def _int_decoder():
+    return lambda payload: int(round(float(payload)))
+
+def _float_decoder():
+    return float
+
+def _json_decoder():
+    return json.loads
+
+def _msgpack_decoder(**options):
+    import msgpack
+    unpackb = msgpack.unpackb
+    return lambda payload: unpackb(payload, **options)
+
+def _cbor_decoder():
+    import cbor2
+    return cbor2.loads
+
+def _struct_decoder(fmt, names=None):
+    """ Fixed layout binary payload (see `struct` module format)
+
+    Gives a dict if `names` is given, else a tuple (or a single value if
+    there is only one field).
+    """
+    unpack = struct.Struct(fmt).unpack
+    if names is not None:
+        names = tuple(names)
+        return lambda payload: dict(zip(names, unpack(payload)))
+    if len(unpack(b"\x00" * struct.calcsize(fmt))) == 1:
+        return lambda payload: unpack(payload)[0]
+    return unpack
+
+def _csv_decoder(names=None, sep=",", cast=float):
+    """ Compact multi-value payload, ex: "21.5,48,1013"
+
+    Gives a dict if `names` is given, else a list.
+    """
+    def split(payload):
+        if isinstance(payload, bytes):
+            # paho gives bytes payloads on Python 3
+            payload = payload.decode("utf-8")
+        return [cast(val) for val in payload.split(sep)]
+    if names is not None:
+        names = tuple(names)
+        return lambda payload: dict(zip(names, split(payload)))
+    return split
+
+DECODERS = {
+    "raw": _raw_decoder,
+    "int": _int_decoder,
+    "float": _float_decoder,
+    "json": _json_decoder,
+    "msgpack": _msgpack_decoder,
+    "cbor": _cbor_decoder,
+    "struct": _struct_decoder,
+    "csv": _csv_decoder,
+}
+
+def register_decoder(name, factory):
+    """ Add a payload decoder, `factory(**options)` should return a
+    function payload -> value
+    """
+    DECODERS[name] = factory
+
+def make_decoder(decoder, **options):
+    """ Build a payload decoder from its name (or return it if callable)
+    """
+    if callable(decoder):
+        return decoder
+    if decoder not in DECODERS:
+        raise ValueError("Unknow decoder: %s" % decoder)
+    return DECODERS[decoder](**options)
 
 
 class MQTTSource(DataSource):
-    """ MQTT source for integer data
+    """ MQTT source, payloads are decoded by `decoder` (name of a registered
+    decoder or function payload -> value)
+
+    For multi-value payloads (dict or list values), `field(key)` gives a
+    source for one of the values.
     """
-    def __init__(self, mqtt_client, topic, name=None, unit=None, timeout=None):
-        assert "#" not in topic
+    __slots__ = ("_decode", "_fields", "mqtt_client")
+
+    decoder = "raw"
+
+    def __init__(self, mqtt_client, topic, name=None, unit=None, timeout=None, decoder=None, decoder_options=None):
         if name is None:
             name= topic.replace("/", "_")
         super(MQTTSource, self).__init__(name=name, unit=unit, timeout=timeout)
+        self._decode = make_decoder(decoder or self.decoder, **(decoder_options or {}))
+        self._fields = None     # key -> DataSource, see `field`
         self.mqtt_client = mqtt_client
         self.mqtt_client.register_source(self, topic=topic)
         self.error = "No data"
 
     def update(self, msg):
-        self._logger.info("%s: get data (%s)" % (self.name, msg.payload))
+        self._logger.debug("%s: get data (%s)", self.name, msg.payload)
         try:
             self.value = self.parse_msg(msg)
             self.error = None
-        except ValueError:
+        except (ValueError, struct.error):
             self.error = "Invalid data"
         except:
             self.error = "Unknow error"
+        else:
+            if self._fields is not None:
+                self._update_fields(self._value)
+
+    def field(self, key, name=None, unit=None):
+        """ Source for one value of a multi-value payload
+        """
+        if self._fields is None:
+            self._fields = {}
+        if key not in self._fields:
+            name = name or "%s_%s" % (self.name, key)
+            self._fields[key] = DataSource(name=name, unit=unit)
+        return self._fields[key]
+
+    def _update_fields(self, value):
+        for key, source in self._fields.items():
+            try:
+                source.value = value[key]
+            except (KeyError, IndexError, TypeError):
+                source.error = "Missing data"
+            else:
+                source.error = None
 
     def start(self):
+        super(MQTTSource, self).start()
         # start client (if needed)
         self.mqtt_client.start()
 
     def parse_msg(self, msg):
-        return msg.payload
+        return self._decode(msg.payload)
 
 
 class IntSource(MQTTSource):
     """ MQTT source for integer data
     """
-    def parse_msg(self, msg):
-        return int(round(float(msg.payload)))
+    __slots__ = ()
+    decoder = "int"
 
 class FloatSource(MQTTSource):
     """ MQTT source for flaot data
     """
-    def parse_msg(self, msg):
-        return float(msg.payload)
+    __slots__ = ()
+    decoder = "float"
+
+
+def benchmark(sizes=(10000, 100000), nb_updates=10):
+    """ Memory used by MQTTSource instances and `set_value` throughput (no
+    broker needed)
+    """
+    client = PipaMQTTClient("benchmark", "localhost")
+    make_source = lambda num: FloatSource(client, topic="bench/%d" % num)
+    basic_benchmark(sizes, nb_updates, make_source=make_source)
+
+
+def main():
+    benchmark()
+    return 0
 
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -9,17 +9,18 @@ import logging
 from time import time
 from datetime import datetime
 
-import requests
 import gevent
 
 from gsensors import AutoUpdateValue
+from gsensors.httppool import default_pool
 
 
 class OwmClient(object):
     ttl = 10*60 # make a request every 10mins max
 
-    def __init__(self, city):
+    def __init__(self, city, http=None):
         self.city = city
+        self.http = http or default_pool()
         self._data = None
         self._last_update = 0
 
@@ -36,7 +37,8 @@ class OwmClient(object):
         return self._data
 
     def _get_data(self):
-        raw = requests.get(self.url)
+        raw = self.http.get(self.url)
+        raw.raise_for_status()
         data = raw.json()
         # ajoute temp in celsius
         data["main"]["celsius"] = data["main"]["temp"] - 273.15
@@ -1,4 +1,5 @@
 #-*- coding:utf-8 -*-
+import socket
 import logging
 
 import psutil
@@ -36,13 +37,13 @@ class DiskUsage(AutoUpdateValue):
         self.value = dd.percent
 
 
-class NutUPS(AutoUpdateValue):
-    """
+class NutVariables(object):
+    """ UPS variables, available as DataSource attributes (see DATA_UNITS)
+
     Doc des variables:
 
     http://www.networkupstools.org/docs/developer-guide.chunked/apas01.html
     """
-    update_freq = 1.
     DATA_UNITS = {
         'battery_charge': '%',
         'battery_charge_low': '%',
@@ -87,6 +88,38 @@ class NutUPS(AutoUpdateValue):
         #'ups_vendorid': ''
     }
 
+    def _init_variables(self):
+        self._sources = {}      # attribute name -> source
+        self._keys = {}         # NUT variable name -> source
+        self._last_data = {}    # NUT variable name -> last value
+
+    def _dispatch(self, data):
+        """ Update the sources whose variable changed since last call
+        """
+        last_data = self._last_data
+        for key, source in self._keys.items():
+            if key not in data:
+                self._logger.debug("Missing data: %s" % key)
+            elif data[key] != last_data.get(key):
+                source.value = data[key]
+        self._last_data = data
+
+    def _source_name(self, value):
+        return value
+
+    def __getattr__(self, value):
+        if value not in self.DATA_UNITS:
+            raise AttributeError("Unknow data")
+        if value not in self._sources:
+            _src = DataSource(name=self._source_name(value), unit=self.DATA_UNITS[value])
+            self._sources[value] = _src
+            self._keys[value.replace("_", ".")] = _src
+        return self._sources[value]
+
+
+class NutUPS(NutVariables, AutoUpdateValue):
+    update_freq = 1.
+
     def __init__(self, upsname, host="127.0.0.1", port=3493, login=None, password=None):
         super(NutUPS, self).__init__()
         self.upsname = upsname
@@ -95,32 +128,190 @@ class NutUPS(AutoUpdateValue):
         self.login = login
         self.password = password
 
-        self._sources = {}
+        self._nut = None        # NUT client, kept connected between updates
+        self._init_variables()
+
+    def _client(self):
+        if self._nut is None:
+            self._logger.debug("Connect to NUT server %s:%s" % (self.host, self.port))
+            self._nut = PyNUTClient(host=self.host, port=self.port, login=self.login, password=self.password)
+        return self._nut
+
+    def _disconnect(self):
+        if self._nut is not None:
+            # PyNUTClient only closes its connection as a context manager
+            self._nut.__exit__(None, None, None)
+            self._nut = None
 
     def update(self):
-        nut = PyNUTClient(host=self.host, port=self.port, login=self.login, password=self.password)
-        # get data
-        #TODO: add try catch on it to detect error
         try:
-            data = nut.list_vars(self.upsname)
-        except PyNUTError as err:
-            self._logger.error(err)
+            data = self._client().list_vars(self.upsname)
+        except (PyNUTError, socket.error, EOFError) as err:
+            self.error_reporter.report("Communication error", err)
             self.error = "Communication error with UPS"
-        else:
-            for name, source in self._sources.items():
-                key = name.replace("_", ".")
-                if key in data:
-                    source.value = data[key]
-                else:
-                    self._logger.debug("Missing data: %s" % key)
-            #pprint(data)
-        del nut #close connection
+            self._disconnect()  # reconnect on next update
+            return
+        self.error = None
+        self._dispatch(data)
 
-    def __getattr__(self, value):
-        if value not in self.DATA_UNITS:
-            raise AttributeError("Unknow data")
-        if value not in self._sources:
-            _src = DataSource(name=value, unit=self.DATA_UNITS[value])
-            self._sources[value] = _src
-        return self._sources[value]
 
+class NutConnection(object):
+    """ Minimal upsd client able to pipeline LIST VAR commands
+
+    All the commands are sent in one write, then the answers are read in
+    order, so polling N UPS costs one round trip instead of N.
+    """
+    timeout = 5
+
+    def __init__(self, host="127.0.0.1", port=3493, login=None, password=None, timeout=None):
+        if timeout is not None:
+            self.timeout = timeout
+        self._sock = socket.create_connection((host, port), self.timeout)
+        self._file = self._sock.makefile("rb")
+        if login is not None:
+            self._command("USERNAME %s" % login)
+        if password is not None:
+            self._command("PASSWORD %s" % password)
+
+    def _send(self, lines):
+        self._sock.sendall("".join("%s\n" % line for line in lines).encode("utf-8"))
+
+    def _readline(self):
+        line = self._file.readline()
+        if not line:
+            raise EOFError("Connection closed by NUT server")
+        return line.decode("utf-8").rstrip("\r\n")
+
+    def _command(self, line):
+        self._send([line])
+        answer = self._readline()
+        if not answer.startswith("OK"):
+            raise PyNUTError(answer)
+
+    @staticmethod
+    def _unquote(value):
+        return value[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+
+    def list_vars(self, upsnames):
+        """ Variables of several UPS, as {upsname: {var: value}}
+
+        The value is a PyNUTError for the UPS that upsd refused (unknown
+        name, driver not connected...).
+        """
+        self._send(["LIST VAR %s" % upsname for upsname in upsnames])
+        res = {}
+        for upsname in upsnames:
+            line = self._readline()
+            if line.startswith("ERR "):
+                res[upsname] = PyNUTError(line)
+                continue
+            if line != "BEGIN LIST VAR %s" % upsname:
+                raise PyNUTError("Unexpected answer: %s" % line)
+            data = {}
+            end = "END LIST VAR %s" % upsname
+            line = self._readline()
+            while line != end:
+                # VAR <upsname> <varname> "<value>"
+                parts = line.split(" ", 3)
+                if len(parts) != 4 or parts[0] != "VAR":
+                    raise PyNUTError("Unexpected answer: %s" % line)
+                data[parts[2]] = self._unquote(parts[3])
+                line = self._readline()
+            res[upsname] = data
+        return res
+
+    def close(self):
+        try:
+            self._send(["LOGOUT"])
+        except socket.error:
+            pass
+        self._file.close()
+        self._sock.close()
+
+
+class NutServerUPS(NutVariables):
+    """ One UPS of a NutServer, same attributes as NutUPS
+    """
+    def __init__(self, server, upsname):
+        self._logger = logging.getLogger("gsensors.NutServerUPS")
+        self.server = server
+        self.upsname = upsname
+        self._init_variables()
+
+    def _source_name(self, value):
+        # several UPS share the server, keep names distinct
+        return "%s_%s" % (self.upsname, value)
+
+    def _set_error(self, error):
+        for source in self._sources.values():
+            source.error = error
+
+    def start(self):
+        self.server.start()
+
+
+class NutServer(AutoUpdateValue):
+    """ Poll several UPS of one upsd server over a single connection
+
+    >>> nut = NutServer("10.0.0.2")                # doctest: +SKIP
+    >>> charge = nut.ups("rack1").battery_charge   # doctest: +SKIP
+    """
+    update_freq = 1.
+
+    def __init__(self, host="127.0.0.1", port=3493, login=None, password=None, name=None):
+        super(NutServer, self).__init__(name=name)
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+
+        self._nut = None        # NutConnection, kept connected between updates
+        self._ups = {}          # upsname -> NutServerUPS
+        self._failing = set()   # names of the UPS refused by upsd
+
+    def ups(self, upsname):
+        if upsname not in self._ups:
+            self._ups[upsname] = NutServerUPS(self, upsname)
+        return self._ups[upsname]
+
+    def _connection(self):
+        if self._nut is None:
+            self._logger.debug("Connect to NUT server %s:%s" % (self.host, self.port))
+            self._nut = NutConnection(self.host, self.port, self.login, self.password)
+        return self._nut
+
+    def _disconnect(self):
+        if self._nut is not None:
+            try:
+                self._nut.close()
+            except (socket.error, EOFError):
+                pass
+            self._nut = None
+
+    def update(self):
+        upsnames = list(self._ups)
+        if not upsnames:
+            return
+        try:
+            res = self._connection().list_vars(upsnames)
+        except (PyNUTError, socket.error, EOFError) as err:
+            self.error_reporter.report("Communication error", err)
+            self.error = "Communication error with NUT server"
+            self._disconnect()  # reconnect on next update
+            for ups in self._ups.values():
+                ups._set_error("Communication error with UPS")
+            return
+        self.error = None
+        for upsname in upsnames:
+            ups = self._ups[upsname]
+            data = res[upsname]
+            if isinstance(data, PyNUTError):
+                if upsname not in self._failing:
+                    # only log the first failure
+                    self._failing.add(upsname)
+                    self._logger.error("%s: %s" % (upsname, data))
+                ups._set_error("Communication error with UPS")
+                continue
+            self._failing.discard(upsname)
+            ups._set_error(None)
+            ups._dispatch(data)
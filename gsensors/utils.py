@@ -1,5 +1,7 @@
 #-*- coding:utf-8 -*-
 import sys
+import time
+from collections import OrderedDict
 
 import logging
 import logging.config
@@ -34,11 +36,11 @@ class FauxTb(object):
         self.tb_next = tb_next
 
 def current_stack(skip=0):
-    try: 1/0
-    except ZeroDivisionError:
-        f = sys.exc_info()[2].tb_frame
-    for i in xrange(skip + 2):
-        f = f.f_back
+    try:
+        f = sys._getframe(skip + 2)
+    except ValueError:
+        # exception handled at the top of the stack
+        return []
     lst = []
     while f is not None:
         lst.append((f, f.f_lineno))
@@ -52,8 +54,75 @@ def extend_traceback(tb, stack):
         head = FauxTb(tb_frame, tb_lineno, head)
     return head
 
-def full_exc_info():
-    """Like sys.exc_info, but includes the full traceback."""
+def full_exc_info(skip=0):
+    """Like sys.exc_info, but includes the full traceback.
+
+    :param skip: nb of frames to skip between the call and the exception handler
+    """
     t, v, tb = sys.exc_info()
-    full_tb = extend_traceback(tb, current_stack(1))
+    full_tb = extend_traceback(tb, current_stack(1 + skip))
     return t, v, full_tb
+
+
+class ErrorReporter(object):
+    """ Log exceptions without flooding the logs
+
+    The full traceback of an error is logged on its first occurrence and
+    then at most once every `interval` seconds (with the number of
+    occurrences meanwhile), other occurrences are only counted.
+
+    Errors are the same if they have the same message, type and origin
+    (file and line where they were raised), whatever their text which may
+    change on each occurrence (ex: object addresses).
+    """
+    interval = 300  # seconds between two full logs of the same error
+    max_errors = 100    # max nb of distinct errors remembered
+
+    def __init__(self, logger, interval=None):
+        self._logger = logger
+        if interval is not None:
+            self.interval = interval
+        self._errors = OrderedDict()   # (msg, error type, origin) -> [count, last log time]
+
+    @staticmethod
+    def _origin(err):
+        """ (file, line) where the exception being handled was raised
+        """
+        tb = sys.exc_info()[2]
+        if tb is None:
+            return str(err)
+        while tb.tb_next is not None:
+            tb = tb.tb_next
+        return (tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+
+    def report(self, msg, err):
+        """ Report the exception being handled
+        """
+        key = (msg, type(err), self._origin(err))
+        now = time.time()
+        entry = self._errors.get(key)
+        if entry is None:
+            if len(self._errors) >= self.max_errors:
+                self._errors.popitem(last=False)
+            self._errors[key] = [0, now]
+            self._logger.error("%s: %s" % (msg, err), exc_info=full_exc_info(1))
+            return
+        entry[0] += 1
+        if now - entry[1] >= self.interval:
+            self._logger.error("%s: %s (%d times in the last %ds)" % (msg, err, entry[0], now - entry[1]),
+                exc_info=full_exc_info(1))
+            entry[0] = 0
+            entry[1] = now
+
+    @property
+    def nb_errors(self):
+        """ Nb of errors not logged yet
+        """
+        return sum(count for count, _ in self._errors.values())
+
+    def clear(self):
+        """ Forget past errors (next ones will be logged in full)
+        """
+        if self._errors:
+            self._logger.info("Recovered (%d errors not logged)" % self.nb_errors)
+            self._errors = OrderedDict()
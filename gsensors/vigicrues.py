@@ -4,6 +4,7 @@ from time import time
 from datetime import datetime
 
 from gsensors import AutoUpdateValue
+from gsensors.httppool import default_pool
 
 class VigicruesStation(object):
     """ Simple class to scrap data from vigicrues website (http://www.vigicrues.gouv.fr/)
@@ -13,8 +14,9 @@ class VigicruesStation(object):
 
     ttl = 15*60 # make a request every 15mins max
 
-    def __init__(self, station_id):
+    def __init__(self, station_id, http=None):
         self.station_id = station_id
+        self.http = http or default_pool()
         self._data = None
         self._last_update = 0
         self.nb_heures = 24 # need to be 24, no data else... (20160119)
@@ -34,8 +36,9 @@ class VigicruesStation(object):
 
     def _get_data(self):
         from pyquery import PyQuery as pq
-        print(self.url_hauteur)
-        data = pq(url=self.url_hauteur)
+        res = self.http.get(self.url_hauteur)
+        res.raise_for_status()
+        data = pq(res.text)
         # get table datas
         all_values = ([td.text for td in pq(tr)("td")] for tr in data("table.liste tr"))
         # filter header